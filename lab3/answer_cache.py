@@ -0,0 +1,77 @@
+# Semantic cache of the chatbot answers
+# A new question reuses a cached answer when its embedding is close enough to a previously answered question
+# and the similarity search returned exactly the same context, so the LLM is not called again.
+import threading
+import time
+import numpy as np
+
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    # threshold: min cosine similarity between two questions to reuse the answer
+    # ttl_seconds: how long an answer stays valid, max_entries: the least recently used are evicted above it
+    def __init__(self, threshold=0.95, ttl_seconds=3600, max_entries=256):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # One slot per entry: the normalised question embeddings are the rows of a matrix, so a lookup is
+        # a single matrix-vector product. The matrix is allocated on the first put, once the dimension is known
+        self.matrix = None
+        self.fingerprints = np.full(max_entries, None, dtype=object)
+        self.answers = [None] * max_entries
+        self.created = np.full(max_entries, -np.inf)
+        self.last_used = np.zeros(max_entries, dtype=np.int64)
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Slots holding an entry that isn't expired (the free slots have never been created), lock held
+    def live_slots(self):
+        return time.monotonic() - self.created <= self.ttl_seconds
+
+    # Returns the cached answer of the most similar question having the same context, or None
+    def get(self, embedding, context_fingerprint):
+        query = normalize(embedding)
+        with self.lock:
+            best = None
+            if self.matrix is not None:
+                candidates = np.flatnonzero(self.live_slots() & (self.fingerprints == context_fingerprint))
+                if len(candidates):
+                    similarities = self.matrix[candidates] @ query
+                    i = int(np.argmax(similarities))
+                    if similarities[i] >= self.threshold:
+                        best = candidates[i]
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.last_used[best] = self.clock
+            return self.answers[best]
+
+    def put(self, embedding, context_fingerprint, answer):
+        vector = normalize(embedding)
+        with self.lock:
+            if self.matrix is None:
+                self.matrix = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            # Reuse a free or expired slot, or else evict the least recently used entry
+            free = np.flatnonzero(~self.live_slots())
+            slot = free[0] if len(free) else int(np.argmin(self.last_used))
+            self.clock += 1
+            self.matrix[slot] = vector
+            self.fingerprints[slot] = context_fingerprint
+            self.answers[slot] = answer
+            self.created[slot] = time.monotonic()
+            self.last_used[slot] = self.clock
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": int(self.live_slots().sum()),
+                    "hit_rate": self.hits / total if total else 0.0}
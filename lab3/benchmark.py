@@ -0,0 +1,235 @@
+# Offline benchmark of the chatbot core logic, without any network access or credentials.
+# Vertex AI is replaced by a fake client (deterministic embeddings, simulated latency) and the similarity
+# search runs on an in-memory LocalVectorIndex filled with random documents, while the rest of chatbot.py
+# (caches, prompt, event loop) is the real code. It reports the latency percentiles of every stage,
+# the throughput with N concurrent sessions and the memory usage, to catch performance regressions on a laptop.
+#
+# python benchmark.py --sessions 8 --rounds 5
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import chatbot
+from answer_cache import SemanticAnswerCache
+from embedding_cache import EmbeddingCache
+from vector_index import LocalVectorIndex, save_snapshot
+
+DEFAULT_QUESTIONS = [
+    "Give me a short resume of what is Glance in OpenStack, based on the provided context ?",
+    "What is the difference between IaaS, PaaS and SaaS ?",
+    "How does Nova schedule a new virtual machine ?",
+    "What is a floating IP ?",
+    "Explain the role of Keystone in OpenStack.",
+    "What is object storage and how is it different from block storage ?",
+    "What are the advantages of Kubernetes deployments over bare pods ?",
+    "What is a circuit breaker in a microservice architecture ?",
+    "How does autoscaling work in a public cloud ?",
+    "What is the CAP theorem ?",
+]
+
+DIMENSIONS = 768
+
+
+# Deterministic unit vector derived from the text, the same text always gives the same embedding
+def fake_embedding(text, dimensions=DIMENSIONS):
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+# Sleep around the given latency (+-20%), to simulate a remote call
+async def simulate_latency(seconds):
+    if seconds > 0:
+        await asyncio.sleep(random.uniform(seconds * 0.8, seconds * 1.2))
+
+
+# Stand-in for google.genai.Client, only the async methods used by chatbot.py are implemented
+class FakeVertexAIModels:
+    def __init__(self, embed_latency, generate_latency, answer_words=80):
+        self.embed_latency = embed_latency
+        self.generate_latency = generate_latency
+        self.answer_words = answer_words
+
+    async def embed_content(self, model, contents):
+        await simulate_latency(self.embed_latency)
+        texts = [contents] if isinstance(contents, str) else contents
+        return types.SimpleNamespace(embeddings=[types.SimpleNamespace(values=fake_embedding(t)) for t in texts])
+
+    def answer_text(self, prompt):
+        return " ".join(f"word{i}" for i in range(self.answer_words))
+
+    def usage_metadata(self, prompt):
+        return types.SimpleNamespace(prompt_token_count=len(prompt) // 4, candidates_token_count=self.answer_words)
+
+    async def generate_content(self, model, contents):
+        await simulate_latency(self.generate_latency)
+        return types.SimpleNamespace(parts=[types.SimpleNamespace(text=self.answer_text(contents))],
+                                     usage_metadata=self.usage_metadata(contents))
+
+    async def generate_content_stream(self, model, contents):
+        words = self.answer_text(contents).split(" ")
+
+        async def stream():
+            # The generation time is spread over the streamed words, the usage comes with the last one
+            for i, word in enumerate(words):
+                await simulate_latency(self.generate_latency / len(words))
+                yield types.SimpleNamespace(
+                    text=word + " ", usage_metadata=self.usage_metadata(contents) if i == len(words) - 1 else None)
+        return stream()
+
+
+class FakeVertexAIClient:
+    def __init__(self, embed_latency, generate_latency):
+        self.aio = types.SimpleNamespace(models=FakeVertexAIModels(embed_latency, generate_latency))
+
+
+# In-memory vector store: a LocalVectorIndex on a snapshot of random documents
+def build_fake_index(snapshot_dir, n_documents):
+    documents = [{"id": str(i), "text": f"Lecture chunk number {i} " * 20, "source": "fake.pdf",
+                  "page": i // 10 + 1, "vector_field": fake_embedding(f"document {i}")}
+                 for i in range(n_documents)]
+    save_snapshot(snapshot_dir, documents)
+    return LocalVectorIndex(snapshot_dir)
+
+
+# Collects the duration of every call of the instrumented stages
+class StageTimer:
+    def __init__(self):
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_async(self, stage, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_async_generator(self, stage, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# Replace the remote services of chatbot.py with the fakes and instrument its stages
+def install_fakes(args, timer, work_dir):
+    client = FakeVertexAIClient(args.embed_latency, args.generate_latency)
+    index = build_fake_index(os.path.join(work_dir, "snapshot"), args.documents)
+    embedding_cache = EmbeddingCache(os.path.join(work_dir, "embedding-cache.sqlite"))
+    # A threshold above 1 never matches, to measure the full pipeline for every question
+    answer_cache = SemanticAnswerCache(threshold=chatbot.ANSWER_CACHE_THRESHOLD if args.cache else 2.0)
+
+    def search(embed_query, top_k=chatbot.RETRIEVAL_TOP_K):
+        if args.search_latency > 0:
+            time.sleep(random.uniform(args.search_latency * 0.8, args.search_latency * 1.2))
+        return index.search(embed_query, top_k)
+
+    chatbot.get_vertex_ai_client = lambda: client
+    chatbot.get_embedding_cache = lambda: embedding_cache
+    chatbot.get_answer_cache = lambda: answer_cache
+    chatbot.warm_up_retrieval = lambda: None
+    chatbot.get_embedding = timer.wrap_async("embed", chatbot.get_embedding)
+    chatbot.similarity_search = timer.wrap("search", search)
+    chatbot.prepare_prompt = timer.wrap("prompt build", chatbot.prepare_prompt)
+    chatbot.generate_answer = timer.wrap_async("generate", chatbot.generate_answer)
+    chatbot.generate_answer_stream = timer.wrap_async_generator("generate", chatbot.generate_answer_stream)
+    return answer_cache
+
+
+# One user session: asks its questions one after the other, like a student in the chat
+def run_session(questions, stream, timer):
+    for question in questions:
+        start = time.perf_counter()
+        if stream:
+            first_token = None
+            for _ in chatbot.generate_ai_answer_stream(question):
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+            timer.record("first token", first_token)
+        else:
+            chatbot.generate_ai_answer(question)
+        timer.record("total", time.perf_counter() - start)
+
+
+def main(args):
+    questions = DEFAULT_QUESTIONS
+    if args.questions:
+        with open(args.questions, 'r') as file:
+            questions = [line.strip() for line in file if line.strip()]
+
+    timer = StageTimer()
+    with tempfile.TemporaryDirectory() as work_dir:
+        answer_cache = install_fakes(args, timer, work_dir)
+
+        start = time.perf_counter()
+        # Each session runs in its own thread, like the streamlit script threads
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            sessions = [executor.submit(run_session, questions * args.rounds, args.stream, timer)
+                        for _ in range(args.sessions)]
+            for session in sessions:
+                session.result()
+        elapsed = time.perf_counter() - start
+
+    n_questions = len(questions) * args.rounds * args.sessions
+    print(f"{n_questions} questions from {args.sessions} concurrent sessions in {elapsed:.2f}s "
+          f"({n_questions / elapsed:.1f} questions/s)")
+    print(f"{'stage':<14}{'calls':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, durations in timer.durations.items():
+        print(f"{stage:<14}{len(durations):>7}" + "".join(
+            f"{value * 1000:>10.1f}" for value in (percentile(durations, 50), percentile(durations, 95),
+                                                   percentile(durations, 99), max(durations))))
+    print(f"Answer cache: {answer_cache.stats()}")
+    # ru_maxrss is in kilobytes on Linux
+    print(f"Peak memory (RSS): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot offline with fake Vertex AI and vector store")
+    parser.add_argument("--questions", help="File with one question per line (a built-in set is used by default)")
+    parser.add_argument("--sessions", type=int, default=4, help="Number of concurrent user sessions")
+    parser.add_argument("--rounds", type=int, default=3, help="Number of times each session asks the question set")
+    parser.add_argument("--documents", type=int, default=5000, help="Number of documents in the fake vector store")
+    parser.add_argument("--embed-latency", type=float, default=0.1, help="Simulated embedding latency (s)")
+    parser.add_argument("--search-latency", type=float, default=0.0,
+                        help="Simulated similarity search latency (s), e.g. to mimic Cosmos DB")
+    parser.add_argument("--generate-latency", type=float, default=1.0, help="Simulated generation latency (s)")
+    parser.add_argument("--stream", action="store_true", help="Use the streaming answers and measure the first token")
+    parser.add_argument("--cache", action="store_true",
+                        help="Keep the semantic answer cache enabled (repeated questions become hits)")
+    args = parser.parse_args()
+    main(args)
@@ -6,7 +6,19 @@ from google.oauth2 import service_account
 from azure.cosmos import CosmosClient
 import streamlit as st
 import configparser
+import hashlib
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import logging
 from langchain_core.prompts import PromptTemplate
+from embedding_cache import EmbeddingCache
+from answer_cache import SemanticAnswerCache
+from context_packing import pack_context, estimate_tokens
+from vector_index import LocalVectorIndex, save_snapshot, snapshot_age
+from metrics import (start_metrics_server, timed, timed_async, timed_async_generator,
+                     record_token_usage, record_cosmos_charge, record_cache)
 
 def load_config():
     config = configparser.ConfigParser()
@@ -24,6 +36,32 @@ AI_MODEL_EMBEDDINGS = config.get('vertexai', 'ai_model_embeddings')
 AI_MODEL_FINAL_PROMPT = config.get('vertexai', 'ai_model_final_prompt')
 VERTEXAI_REGION = config.get('vertexai', 'region')
 
+EMBEDDING_CACHE_FILE = config.get('cache', 'embedding_cache_file', fallback='embedding-cache.sqlite')
+EMBEDDING_CACHE_MAX_MB = config.getint('cache', 'embedding_cache_max_mb', fallback=512)
+ANSWER_CACHE_THRESHOLD = config.getfloat('cache', 'answer_cache_similarity_threshold', fallback=0.95)
+ANSWER_CACHE_TTL_SECONDS = config.getint('cache', 'answer_cache_ttl_seconds', fallback=3600)
+ANSWER_CACHE_MAX_ENTRIES = config.getint('cache', 'answer_cache_max_entries', fallback=256)
+
+STREAM_ANSWERS = config.getboolean('chatbot', 'stream_answers', fallback=True)
+# DEBUG also logs the embeddings, the context, the prompts and the raw responses of every question
+LOG_LEVEL = config.get('chatbot', 'log_level', fallback='INFO')
+METRICS_PORT = config.getint('chatbot', 'metrics_port', fallback=9100)
+BLOCKING_WORKERS = config.getint('chatbot', 'blocking_workers', fallback=64)
+
+RETRIEVAL_BACKEND = config.get('retrieval', 'backend', fallback='cosmos')
+RETRIEVAL_TOP_K = config.getint('retrieval', 'top_k', fallback=10)
+SNAPSHOT_DIR = config.get('retrieval', 'snapshot_dir', fallback='vector-snapshot')
+SNAPSHOT_MAX_AGE_HOURS = config.getfloat('retrieval', 'snapshot_max_age_hours', fallback=24)
+IVF_LISTS = config.getint('retrieval', 'ivf_lists', fallback=0)
+IVF_PROBES = config.getint('retrieval', 'ivf_probes', fallback=4)
+CONTEXT_TOKEN_BUDGET = config.getint('retrieval', 'context_token_budget', fallback=2000)
+CONTEXT_MMR_LAMBDA = config.getfloat('retrieval', 'context_mmr_lambda', fallback=0.7)
+CONTEXT_MIN_SCORE = config.get('retrieval', 'context_min_score', fallback='')
+CONTEXT_MIN_SCORE = float(CONTEXT_MIN_SCORE) if CONTEXT_MIN_SCORE else None
+
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(message)s')
+logger = logging.getLogger(__name__)
+
 # configuring streamlit page settings
 st.set_page_config(
     page_title="cloud lecture lab",
@@ -35,7 +73,10 @@ st.set_page_config(
 st.title("Chat with your lecture")
 
 
+# The clients are created once per process and shared by all sessions and reruns of the script,
+# so questions reuse the same HTTP sessions and TLS connections instead of opening new ones.
 # CosmoDB client
+@st.cache_resource
 def get_cosmos_client():
     cosmos_url = "https://{0}.documents.azure.com:443/".format(
         AZURE_ACCOUNT_NAME)
@@ -44,6 +85,15 @@ def get_cosmos_client():
     return CosmosClient(cosmos_url, credential=key)
 
 
+@st.cache_resource
+def get_cosmos_container():
+    database = get_cosmos_client().get_database_client(AZURE_ACCOUNT_NAME)
+    return database.get_container_client(AZURE_CONTAINER_NAME)
+
+
+# The access token of the service account expires after an hour,
+# the client refreshes it by itself from the credentials before sending a request with an expired token
+@st.cache_resource
 def get_vertex_ai_client():
     scopes = ['https://www.googleapis.com/auth/cloud-platform']
     creds = service_account.Credentials.from_service_account_file(
@@ -51,33 +101,145 @@ def get_vertex_ai_client():
     return Client(vertexai=True, project=VERTEXAI_PROJECT_ID, location=VERTEXAI_REGION, credentials=creds)
 
 
-def get_embedding(text):
+# Streamlit reruns the script on every interaction, the cache must be opened once per process
+@st.cache_resource
+def get_embedding_cache():
+    return EmbeddingCache(EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+
+
+# Shared by all the sessions, so a question asked by a student can answer the same question of another one
+@st.cache_resource
+def get_answer_cache():
+    return SemanticAnswerCache(ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES)
+
+
+# Event loop shared by all the streamlit sessions, running in a background thread.
+# The network calls of every session are multiplexed on it, and the steps of a question are coroutines
+# so independent work can run at the same time.
+# The blocking calls (Cosmos DB search, SQLite cache) go through asyncio.to_thread, so the loop gets its own
+# executor: the default one has min(32, cpus + 4) threads, and would serialise the sessions on a small VM.
+@st.cache_resource
+def get_event_loop():
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="chatbot"))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+# Prometheus metrics endpoint, started once per process (0 disables it)
+@st.cache_resource
+def start_metrics():
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+        logger.info(f"Prometheus metrics available on port {METRICS_PORT}")
+
+
+# Run a coroutine on the shared event loop and wait for its result
+def run_async(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop()).result()
+
+
+# Iterate over an async generator running on the shared event loop, from synchronous code (e.g. st.write_stream)
+def iter_async(async_generator):
+    items = queue.Queue()
+
+    async def pump():
+        try:
+            async for item in async_generator:
+                items.put((True, item))
+            items.put((False, None))
+        except Exception as e:
+            items.put((False, e))
+
+    asyncio.run_coroutine_threadsafe(pump(), get_event_loop())
+    while True:
+        has_item, item = items.get()
+        if not has_item:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+async def embed_texts(texts):
     client = get_vertex_ai_client()
 
-    result = client.models.embed_content(
+    result = await client.aio.models.embed_content(
         model=AI_MODEL_EMBEDDINGS,
-        contents=text,
+        contents=texts,
     )
-    return result.embeddings[0]  # the list contain a single element
+    return [e.values for e in result.embeddings]
+
+
+# Returns the embedding of the text as a list of floats, repeated questions are taken from the cache
+@timed_async("embed")
+async def get_embedding(text):
+    cache = get_embedding_cache()
+    cached = (await asyncio.to_thread(cache.get_many, AI_MODEL_EMBEDDINGS, [text]))[0]
+    record_cache("embedding", cached is not None)
+    if cached is not None:
+        return cached
+    embedding = (await embed_texts([text]))[0]
+    await asyncio.to_thread(cache.put_many, AI_MODEL_EMBEDDINGS, [text], [embedding])
+    return list(embedding)
 
 
 # Cosmos DB equivalent of similarity_search()
-def similarity_search_cosmos_db(embed_query, vector_field='vector_field', top_k=5):
-    client = get_cosmos_client()
-    database = client.get_database_client(AZURE_ACCOUNT_NAME)
-    container = database.get_container_client(AZURE_CONTAINER_NAME)
+def similarity_search_cosmos_db(embed_query, vector_field='vector_field', top_k=10):
+    container = get_cosmos_container()
 
     # Query to do a similarity search between the embed_query and the cosmos database entries.
-    # Get the text, the source (the file path) and take the 10 most relevant entries
+    # Get the text, the source (the file path) and take the top_k most relevant entries
     return list(container.query_items(
-        query='SELECT TOP 10 c.text, c.source,\
-            VectorDistance(c.vector_field,@embedding) AS SimilarityScore FROM c\
-            ORDER BY VectorDistance(c.vector_field,@embedding)',
-        parameters=[{"name": "@embedding", "value": embed_query.values}],
-        enable_cross_partition_query=True))
-
-
-def prepare_prompt(question, context):
+        query='SELECT TOP @top_k c.id, c.text, c.source, c.page,\
+            VectorDistance(c.{0},@embedding) AS SimilarityScore FROM c\
+            ORDER BY VectorDistance(c.{0},@embedding)'.format(vector_field),
+        parameters=[{"name": "@embedding", "value": embed_query},
+                    {"name": "@top_k", "value": top_k}],
+        enable_cross_partition_query=True,
+        response_hook=record_cosmos_charge))
+
+
+# Download all the documents of the Cosmos DB container into a local snapshot for LocalVectorIndex
+def export_cosmos_snapshot(snapshot_dir):
+    logger.info(f"Exporting the Cosmos DB documents into {snapshot_dir}")
+    documents = get_cosmos_container().query_items(
+        query='SELECT c.id, c.text, c.source, c.page, c.vector_field FROM c',
+        enable_cross_partition_query=True,
+        response_hook=record_cosmos_charge)
+    save_snapshot(snapshot_dir, list(documents))
+
+
+# The snapshot is exported again from Cosmos DB when it's too old, and the index reloaded
+@st.cache_resource(ttl=SNAPSHOT_MAX_AGE_HOURS * 3600)
+def get_local_vector_index():
+    age = snapshot_age(SNAPSHOT_DIR)
+    if age is None or age > SNAPSHOT_MAX_AGE_HOURS * 3600:
+        export_cosmos_snapshot(SNAPSHOT_DIR)
+    return LocalVectorIndex(SNAPSHOT_DIR, IVF_LISTS, IVF_PROBES)
+
+
+# Similarity search with the backend selected in config.ini:
+# "cosmos" sends a query to Cosmos DB, "local" searches the in-process index without any network call
+@timed("search")
+def similarity_search(embed_query, top_k=RETRIEVAL_TOP_K):
+    if RETRIEVAL_BACKEND == 'local':
+        return get_local_vector_index().search(embed_query, top_k)
+    return similarity_search_cosmos_db(embed_query, top_k=top_k)
+
+
+# Make sure the retrieval backend is ready (local index loaded, Cosmos DB container client created)
+# Done while the question is embedded, so the first question doesn't pay it after the embedding
+def warm_up_retrieval():
+    if RETRIEVAL_BACKEND == 'local':
+        get_local_vector_index()
+    else:
+        get_cosmos_container()
+
+
+# The template is the same for every question, it's parsed once per process
+@st.cache_resource
+def get_prompt_template():
     template = """
     You are a Professor. The student will ask you a questions about the lecture. 
     Use following piece of context to answer the question. 
@@ -91,47 +253,135 @@ def prepare_prompt(question, context):
 
     """
 
-    prompt = PromptTemplate(
+    return PromptTemplate(
         template=template,
         input_variables=['context', 'question']
     )
-    prompt_formatted_str = prompt.format(context=context, question=question)
+
+
+@timed("prompt")
+def prepare_prompt(question, context):
+    prompt_formatted_str = get_prompt_template().format(context=context, question=question)
     return prompt_formatted_str
 
 
-def generate_answer(prompt):
+@timed_async("generate")
+async def generate_answer(prompt):
     client = get_vertex_ai_client()
-    print(f"Using chat model: {AI_MODEL_FINAL_PROMPT}")
-    response = client.models.generate_content(
+    logger.debug(f"Using chat model: {AI_MODEL_FINAL_PROMPT}")
+    response = await client.aio.models.generate_content(
         model=AI_MODEL_FINAL_PROMPT,
         contents=prompt,
     )
-    print(response)
+    logger.debug(response)
+    record_token_usage(response.usage_metadata)
     return "\n".join([a.text for a in response.parts])  # join the list of text values to have a single string
 
 
+# Same as generate_answer() but yields the text as soon as the model produces it
+@timed_async_generator("generate")
+async def generate_answer_stream(prompt):
+    client = get_vertex_ai_client()
+    logger.debug(f"Using chat model: {AI_MODEL_FINAL_PROMPT} (streaming)")
+    usage_metadata = None
+    async for chunk in await client.aio.models.generate_content_stream(
+        model=AI_MODEL_FINAL_PROMPT,
+        contents=prompt,
+    ):
+        # The usage of the whole answer is given with the last chunks
+        usage_metadata = chunk.usage_metadata or usage_metadata
+        if chunk.text:
+            yield chunk.text
+    record_token_usage(usage_metadata)
+
+
+# Only the relevant and non redundant chunks are kept in the context, within the token budget
+@timed("pack")
+def build_context(sim_results):
+    packed_results = pack_context(sim_results, CONTEXT_TOKEN_BUDGET, CONTEXT_MMR_LAMBDA, CONTEXT_MIN_SCORE)
+    context = "\n".join([i['text'] for i in packed_results])
+    logger.debug("Context packed from %d to %d chunks (%d estimated tokens)",
+                 len(sim_results), len(packed_results), estimate_tokens(context))
+    return context
+
+
+# Identifies the set of documents returned by the similarity search
+def context_fingerprint(sim_results):
+    ids = sorted(item.get('id') or item['text'] for item in sim_results)
+    return hashlib.sha256("\0".join(ids).encode('utf-8')).hexdigest()
+
+
+# Embedding, similarity search and answer cache lookup, common to the blocking and streaming answers
+# Returns the question embedding, the context, its fingerprint and the cached answer (None on cache miss)
+async def retrieve_context(user_prompt):
+    # The retrieval backend and the prompt template don't depend on the question, they are prepared meanwhile
+    embed_question, _, _ = await asyncio.gather(
+        get_embedding(user_prompt),
+        asyncio.to_thread(warm_up_retrieval),
+        asyncio.to_thread(get_prompt_template))
+    logger.debug("Question as embeddings: %s", embed_question[:100])
+    sim_results = await asyncio.to_thread(similarity_search, embed_question)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Context extracted from similarity search\n" + "\n".join(
+            "- [{0}] {1}".format(item['SimilarityScore'], item['text']) for item in sim_results))
+    context = build_context(sim_results)
+
+    # A similar question with the same context was already answered, no need to ask the LLM again
+    answer_cache = get_answer_cache()
+    fingerprint = context_fingerprint(sim_results)
+    cached_answer = await asyncio.to_thread(answer_cache.get, embed_question, fingerprint)
+    record_cache("answer", cached_answer is not None)
+    logger.debug("Answer cache: %s", answer_cache.stats())
+    if cached_answer is not None:
+        logger.debug("Final answer from the answer cache:\n%s", cached_answer)
+    return embed_question, context, fingerprint, cached_answer
+
+
+# Async version of generate_ai_answer(), to be awaited on the shared event loop
+async def answer_question(user_prompt):
+    embed_question, context, fingerprint, cached_answer = await retrieve_context(user_prompt)
+    if cached_answer is not None:
+        return cached_answer
+
+    prompt = prepare_prompt(user_prompt, context)
+    logger.debug("Last prompt with question and prompt:\n%s", prompt)
+    result = await generate_answer(prompt)
+    logger.debug("Final answer from the AI:\n%s", result)
+    await asyncio.to_thread(get_answer_cache().put, embed_question, fingerprint, result)
+    return result
+
+
+# Async streaming version of answer_question(), yields the answer piece by piece
+async def answer_question_stream(user_prompt):
+    embed_question, context, fingerprint, cached_answer = await retrieve_context(user_prompt)
+    if cached_answer is not None:
+        yield cached_answer
+        return
+
+    prompt = prepare_prompt(user_prompt, context)
+    logger.debug("Last prompt with question and prompt:\n%s", prompt)
+    parts = []
+    async for text in generate_answer_stream(prompt):
+        parts.append(text)
+        yield text
+    result = "".join(parts)
+    logger.debug("Final answer from the AI:\n%s", result)
+    await asyncio.to_thread(get_answer_cache().put, embed_question, fingerprint, result)
+
+
 # The entrypoint of the core logic, to be called by test.py
 def generate_ai_answer(user_prompt):
-    embed_question = get_embedding(user_prompt)
-    print("Question as embeddings:")
-    print(embed_question.values[:100])
-    sim_results = similarity_search_cosmos_db(embed_question)
+    return run_async(answer_question(user_prompt))
 
-    print("Context extracted from similarity search")
-    for item in sim_results:
-        print("- [{0}] {1}".format(item['SimilarityScore'], item['text']))
-    context = "\n".join([i['text'] for i in sim_results])
 
-    prompt = prepare_prompt(user_prompt, context)
-    print("Last prompt with question and prompt")
-    print(prompt)
-    result = generate_answer(prompt)
-    print("Final answer from the AI")
-    print(result)
-    return result
+# Streaming version of generate_ai_answer(), yields the answer piece by piece
+def generate_ai_answer_stream(user_prompt):
+    return iter_async(answer_question_stream(user_prompt))
 
 
 def main():
+    start_metrics()
 
     # initialize chat session in streamlit if not already present
     if "chat_history" not in st.session_state:
@@ -151,14 +401,21 @@ def main():
         st.session_state.chat_history.append(
             {"role": "user", "content": user_prompt})
         # Generate and display answer
-        print(user_prompt)
-
-        answer = generate_ai_answer(user_prompt)
-        st.session_state.chat_history.append(
-            {"role": "system", "content": answer})
-        for message in st.session_state.chat_history[-1:]:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+        logger.info(f"Question: {user_prompt}")
+
+        if STREAM_ANSWERS:
+            # Display the answer while it's generated, st.write_stream() returns the full text at the end
+            with st.chat_message("system"):
+                answer = st.write_stream(generate_ai_answer_stream(user_prompt))
+            st.session_state.chat_history.append(
+                {"role": "system", "content": answer})
+        else:
+            answer = generate_ai_answer(user_prompt)
+            st.session_state.chat_history.append(
+                {"role": "system", "content": answer})
+            for message in st.session_state.chat_history[-1:]:
+                with st.chat_message(message["role"]):
+                    st.markdown(message["content"])
 
 
 if __name__ == "__main__":
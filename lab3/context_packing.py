@@ -0,0 +1,112 @@
+# Assembly of the context given to the LLM from the similarity search results
+# The chunks overlap by construction (iter_chunks(pdfs, 1000, 100) in vectorise-store.py) and often repeat the same
+# content, so before building the prompt we:
+# 1. drop the results under a min score and the exact duplicates
+# 2. merge the chunks of the same source and page that overlap, without repeating the overlapping text
+# 3. order them by MMR (Maximal Marginal Relevance), to prefer relevant chunks that bring new content
+# 4. keep them in this order while they fit in the token budget
+import re
+
+# Overlaps shorter than that are considered as a coincidence
+MIN_OVERLAP = 20
+MAX_OVERLAP = 300
+
+
+# Rough token count of a text, about 4 characters per token for Gemini models
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+# Length of the longest end of a that is also the start of b, 0 if it's shorter than MIN_OVERLAP
+def overlap_length(a, b):
+    if len(b) < MIN_OVERLAP:
+        return 0
+    # Only the positions where the start of b appears in the end of a can be an overlap, the first one is the longest
+    head = b[:MIN_OVERLAP]
+    position = a.find(head, max(0, len(a) - MAX_OVERLAP))
+    while position != -1:
+        if b.startswith(a[position:]):
+            return len(a) - position
+        position = a.find(head, position + 1)
+    return 0
+
+
+# Merge the chunks of the same source and page that follow each other (the end of one is the start of another)
+def merge_adjacent(items):
+    items = list(items)
+    merged = True
+    while merged:
+        merged = False
+        for i, a in enumerate(items):
+            for j, b in enumerate(items):
+                if i == j or (a.get('source'), a.get('page')) != (b.get('source'), b.get('page')):
+                    continue
+                length = overlap_length(a['text'], b['text'])
+                if length:
+                    items[i] = {**a, 'text': a['text'] + b['text'][length:],
+                                'SimilarityScore': max(a['SimilarityScore'], b['SimilarityScore'])}
+                    del items[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return items
+
+
+def words(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+
+# Jaccard similarity of the words of two texts, used as redundancy measure between two chunks
+def text_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+# Order the items by Maximal Marginal Relevance: at each step take the item maximizing
+# mmr_lambda * relevance - (1 - mmr_lambda) * max similarity with the items already taken
+def mmr_order(items, mmr_lambda):
+    if not items:
+        return []
+    scores = [item['SimilarityScore'] for item in items]
+    lowest, highest = min(scores), max(scores)
+    # Relevance scaled in [0, 1] to be comparable with the text similarity
+    relevance = [(score - lowest) / (highest - lowest) if highest > lowest else 1.0 for score in scores]
+    item_words = [words(item['text']) for item in items]
+
+    remaining = list(range(len(items)))
+    selected = []
+    while remaining:
+        best = max(remaining, key=lambda i: mmr_lambda * relevance[i] - (1 - mmr_lambda) * max(
+            (text_similarity(item_words[i], item_words[j]) for j in selected), default=0.0))
+        selected.append(best)
+        remaining.remove(best)
+    return [items[i] for i in selected]
+
+
+# Returns the search results to put in the context, best first, whose total size stays under token_budget
+def pack_context(sim_results, token_budget=2000, mmr_lambda=0.7, min_score=None):
+    items = [item for item in sim_results if min_score is None or item['SimilarityScore'] >= min_score]
+
+    unique_texts = set()
+    unique_items = []
+    for item in items:
+        if item['text'] not in unique_texts:
+            unique_texts.add(item['text'])
+            unique_items.append(item)
+
+    packed = []
+    used_tokens = 0
+    for item in mmr_order(merge_adjacent(unique_items), mmr_lambda):
+        tokens = estimate_tokens(item['text'])
+        if used_tokens + tokens > token_budget:
+            # A smaller chunk further in the list may still fit
+            continue
+        packed.append(item)
+        used_tokens += tokens
+    # Even the best chunk is bigger than the budget, keep its beginning rather than no context at all
+    if not packed and unique_items:
+        best = max(unique_items, key=lambda item: item['SimilarityScore'])
+        packed.append({**best, 'text': best['text'][:token_budget * 4]})
+    return packed
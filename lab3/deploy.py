@@ -1,6 +1,10 @@
-# This script is used to deploy the local files of the current folder into the VM
+# This script is used to deploy the local files of the current folder into the VM(s)
 # and execute the final commands in deploy.sh
 import argparse
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from scp import SCPClient
 from paramiko import SSHClient, AutoAddPolicy
 import os.path
@@ -17,56 +21,114 @@ config = load_config()
 
 PRIVATE_KEYPAIR_FILE = config.get('switch', 'private_keypair_file')
 CLOUDS_YAML = config.get('switch', 'clouds_yaml')
-FILES_TO_UPLOAD = ["chatbot.py", "requirements.txt", "deploy.sh", "config.ini", "azure-db-key.txt", "vertexai-service-account-key.json"]
+FILES_TO_UPLOAD = ["chatbot.py", "embedding_cache.py", "answer_cache.py", "vector_index.py", "metrics.py", "context_packing.py", "requirements.txt", "deploy.sh", "config.ini", "azure-db-key.txt", "vertexai-service-account-key.json"]
 DEPLOY_ROOT_FOLDER = '/home/ubuntu'
 
-def deploy(username, host):
-    # Make sure all FILES_TO_UPLOAD do exist
-    for file in FILES_TO_UPLOAD:
-        if not os.path.isfile(file):
-            print(f"Error: file {file} should exist for the deployment !")
-            return
+# sha256 of the local files, computed once for all the hosts
+def local_checksums(files):
+    checksums = {}
+    for file in files:
+        with open(file, 'rb') as f:
+            checksums[file] = hashlib.sha256(f.read()).hexdigest()
+    return checksums
 
-    ssh = SSHClient()
 
-    ssh.set_missing_host_key_policy(AutoAddPolicy())
-    ssh.connect(host, 22, username, key_filename=PRIVATE_KEYPAIR_FILE)
+# sha256 of the files already deployed on the host, the missing files are not in the result
+def remote_checksums(ssh, files):
+    _, stdout, _ = ssh.exec_command(f"cd {DEPLOY_ROOT_FOLDER} && sha256sum {' '.join(files)} 2>/dev/null")
+    checksums = {}
+    for line in stdout.read().decode().splitlines():
+        checksum, _, file = line.partition("  ")
+        checksums[file] = checksum
+    return checksums
 
-    scp = SCPClient(ssh.get_transport())
 
-    print("Uploading chatbot related files into the VM")
+print_lock = threading.Lock()
 
-    for file in FILES_TO_UPLOAD:
-        scp.put(file, remote_path=f"{DEPLOY_ROOT_FOLDER}/{file}")
 
-    scp.close()
+# Print the lines of every host prefixed by its name, without mixing the lines of two hosts
+def log(host, message, end='\n'):
+    with print_lock:
+        print(f"[{host}] {message}", end=end)
+
 
-    print("Starting deploy.sh on the VM")
+# Deploy to a single host with one SSH connection: only the files whose checksum changed are uploaded,
+# then deploy.sh is run and its output is streamed. Returns True on success.
+def deploy(username, host, checksums, force=False):
+    ssh = SSHClient()
+
+    ssh.set_missing_host_key_policy(AutoAddPolicy())
+    ssh.connect(host, 22, username, key_filename=PRIVATE_KEYPAIR_FILE)
+
+    try:
+        deployed = {} if force else remote_checksums(ssh, FILES_TO_UPLOAD)
+        changed = [file for file in FILES_TO_UPLOAD if deployed.get(file) != checksums[file]]
+        log(host, f"Uploading {len(changed)} changed chatbot related files into the VM "
+                  f"({len(FILES_TO_UPLOAD) - len(changed)} unchanged)")
+
+        if changed:
+            scp = SCPClient(ssh.get_transport())
+            for file in changed:
+                scp.put(file, remote_path=f"{DEPLOY_ROOT_FOLDER}/{file}")
+            scp.close()
+
+        log(host, "Starting deploy.sh on the VM")
+
+        # Execute and capture output
+        stdin, stdout, stderr = ssh.exec_command(f"cd {DEPLOY_ROOT_FOLDER} && bash deploy.sh")
+
+        # Print output in real-time
+        while True:
+            line = stdout.readline()
+            if not line:
+                break
+            log(host, line, end='')
+
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            for line in stderr.readlines():
+                log(host, f"ERROR: {line}", end='')
+            log(host, f"Deployment failed with exit status {exit_status}")
+            return False
+    finally:
+        ssh.close()
+
+    log(host, f"CHATBOT HAS BEEN DEPLOYED... Please open http://{host}:8501 in your Web browser !")
+    return True
+
+
+# Deploy to all the hosts at the same time, the total time is the time of the slowest host
+def deploy_all(username, hosts, force=False):
+    # Make sure all FILES_TO_UPLOAD do exist
+    for file in FILES_TO_UPLOAD:
+        if not os.path.isfile(file):
+            print(f"Error: file {file} should exist for the deployment !")
+            return
 
-    # Execute and capture output
-    stdin, stdout, stderr = ssh.exec_command(f"cd {DEPLOY_ROOT_FOLDER} && bash deploy.sh")
+    start = time.perf_counter()
+    checksums = local_checksums(FILES_TO_UPLOAD)
 
-    # Print output in real-time
-    while True:
-        line = stdout.readline()
-        if not line:
-            break
-        print(line, end='')
+    def deploy_host(host):
+        try:
+            return deploy(username, host, checksums, force)
+        except Exception as e:
+            log(host, f"Deployment failed: {e}")
+            return False
 
-    exit_status = stdout.channel.recv_exit_status()
-    if exit_status != 0:
-        for line in stderr.readlines():
-            print(f"ERROR: {line}", end='')
-        print(f"\nDeployment failed with exit status {exit_status}")
-        return
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        results = list(executor.map(deploy_host, hosts))
 
-    print(f"\n\nCHATBOT HAS BEEN DEPLOYED...\nPlease open http://{host}:8501 in your Web browser !")
+    failed = [host for host, success in zip(hosts, results) if not success]
+    print(f"\nDeployed to {len(hosts) - len(failed)}/{len(hosts)} hosts in {time.perf_counter() - start:.1f}s")
+    if failed:
+        print(f"Failed hosts: {', '.join(failed)}")
 
 
 if __name__ == "__main__":
     # parse arg
-    parser = argparse.ArgumentParser(description="Give the VM hostname")
-    parser.add_argument("--host", type=str, help="hostname")
+    parser = argparse.ArgumentParser(description="Give the VM hostname(s)")
+    parser.add_argument("--host", type=str, nargs="+", required=True, help="hostname, or several to deploy them in parallel")
+    parser.add_argument("--force", action="store_true", help="Upload all the files, even the unchanged ones")
     args = parser.parse_args()
 
-    deploy("ubuntu", args.host)
+    deploy_all("ubuntu", args.host, args.force)
@@ -0,0 +1,93 @@
+# Persistent embedding cache shared by vectorise-store.py and chatbot.py
+# Embeddings are stored in a SQLite file as float32 blobs, keyed by the hash of the model name and the text,
+# so the same text is never sent twice to Vertex AI for the same model.
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    # max_bytes is the max total size of the stored vectors, the least recently used are evicted above it
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # The same cache is used from several threads (ingestion pipeline, streamlit sessions)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            last_used REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.total_bytes = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    # Returns the cached embedding of each text, or None when it's not in the cache
+    def get_many(self, model, texts):
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            # Stay under the default SQLite limit of 999 variables per query
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                found.update(self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch))
+            if found:
+                now = time.time()
+                self.db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                    [(now, key) for key in found])
+                self.db.commit()
+        return [array('f', found[key]).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model, texts, embeddings):
+        now = time.time()
+        # A text repeated in the batch (e.g. empty pages) must only be counted once in total_bytes
+        rows = {}
+        for text, embedding in zip(texts, embeddings):
+            key = cache_key(model, text)
+            rows[key] = (key, array('f', embedding).tobytes(), now)
+        rows = list(rows.values())
+        with self.lock:
+            for key, vector, _ in rows:
+                previous = self.db.execute(
+                    "SELECT LENGTH(vector) FROM embeddings WHERE key = ?", (key,)).fetchone()
+                self.total_bytes += len(vector) - (previous[0] if previous else 0)
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows)
+            self.evict()
+            self.db.commit()
+
+    # Remove the least recently used embeddings until the cache fits in max_bytes
+    # Must be called with the lock held
+    def evict(self):
+        while self.total_bytes > self.max_bytes:
+            oldest = self.db.execute(
+                "SELECT key, LENGTH(vector) FROM embeddings ORDER BY last_used LIMIT 100").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.total_bytes -= size
+
+
+# Embed the texts with embed_func (a function taking a list of texts and returning a list of embeddings)
+# but only for the texts that are not already in the cache
+def embed_with_cache(cache, model, texts, embed_func):
+    embeddings = cache.get_many(model, texts)
+    # Each missing text is embedded once, even if it appears several times in texts
+    missing = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    if missing:
+        new_embeddings = dict(zip(missing, embed_func(missing)))
+        cache.put_many(model, missing, list(new_embeddings.values()))
+        embeddings = [list(new_embeddings[text]) if embedding is None else embedding
+                      for text, embedding in zip(texts, embeddings)]
+    return embeddings
@@ -1,21 +1,66 @@
 import os
 import argparse
-from openstack import connection
+import hashlib
+import json
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from openstack import connection, exceptions
 from openstack.config import OpenStackConfig
 import configparser
 
-def list_container(conn):
-    containers = list(conn.object_store.containers())
-    if not containers:
-        print("No containers.")
-        return
+def format_size(n_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n_bytes < 1024:
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} TB"
+
 
+# Number of objects asked per listing request, the listing is read page by page (Swift returns at most 10000)
+LISTING_PAGE_SIZE = 10000
+
+
+# Summary of every container, with the object count and size given by the account listing (no request per
+# container). With details, the objects of each container are listed page by page to compute the statistics,
+# and printed one by one with verbose.
+def list_container(conn, details=False, verbose=False):
+    total_objects = 0
+    total_bytes = 0
+    n_containers = 0
     print("Containers available :")
-    for c in containers:
-        print(f"- {c.name} , container_read: {c.metadata}")
-        for obj in conn.object_store.objects(c.name):
-            size = getattr(obj, "size", getattr(obj, "content_length", "unknown"))
-            print(f"Found object in container: {obj.name}, size={size} bytes")
+    for c in conn.object_store.containers(limit=LISTING_PAGE_SIZE):
+        n_containers += 1
+        total_objects += c.count or 0
+        total_bytes += c.bytes or 0
+        print(f"- {c.name}: {c.count} objects, {format_size(c.bytes or 0)}")
+        if not details:
+            continue
+
+        count = 0
+        size = 0
+        largest = None
+        by_extension = {}
+        for obj in conn.object_store.objects(c.name, limit=LISTING_PAGE_SIZE):
+            obj_size = obj.content_length or 0
+            count += 1
+            size += obj_size
+            if largest is None or obj_size > largest[1]:
+                largest = (obj.name, obj_size)
+            extension = os.path.splitext(obj.name)[1].lower() or "(none)"
+            ext_count, ext_size = by_extension.get(extension, (0, 0))
+            by_extension[extension] = (ext_count + 1, ext_size + obj_size)
+            if verbose:
+                print(f"    {obj.name}, size={obj_size} bytes")
+        if count:
+            print(f"    average size {format_size(size / count)}, largest {largest[0]} ({format_size(largest[1])})")
+            for extension, (ext_count, ext_size) in sorted(by_extension.items(), key=lambda item: -item[1][1]):
+                print(f"    {extension}: {ext_count} objects, {format_size(ext_size)}")
+
+    if not n_containers:
+        print("No containers.")
+        return
+    print(f"Total: {n_containers} containers, {total_objects} objects, {format_size(total_bytes)}")
 
 def get_container_public_url(conn, container_name):
     # Récupérer l'endpoint public du service object-store (Swift)
@@ -27,8 +72,87 @@ def get_container_public_url(conn, container_name):
     public_url = f"{endpoint}/{account}/{container_name}"
     return public_url
 
-def upload_pdfs(conn, container_name, pdf_path):
-    # Upload PDF file
+# Files bigger than the segment size are uploaded as Static Large Objects: the segments are stored
+# in the "<container>_segments" container and the object itself is a manifest listing them
+def segments_container(container_name):
+    return f"{container_name}_segments"
+
+
+# Relative URL of an object, for the requests sent directly with conn.object_store
+def object_endpoint(container_name, name):
+    return f"{urllib.parse.quote(container_name)}/{urllib.parse.quote(name)}"
+
+
+# Listing of a container: {object name: (size, hash)}, the hash is the MD5 of the object,
+# or for a large object the MD5 of the concatenated MD5 of its segments
+def list_remote_objects(conn, container_name, prefix=None):
+    remote = {}
+    try:
+        for obj in conn.object_store.objects(container_name, prefix=prefix):
+            remote[obj.name] = (obj.content_length, (obj.etag or "").strip('"'))
+    except Exception:
+        pass  # the container doesn't exist yet
+    return remote
+
+
+# MD5 of each segment of the file, and the hashes Swift would give to the whole file:
+# the plain MD5 and the large object one (MD5 of the segment MD5s)
+def local_hashes(file_path, segment_size):
+    file_md5 = hashlib.md5()
+    segment_md5s = []
+    with open(file_path, 'rb') as f:
+        while segment := f.read(segment_size):
+            file_md5.update(segment)
+            segment_md5s.append(hashlib.md5(segment).hexdigest())
+    slo_etag = hashlib.md5("".join(segment_md5s).encode()).hexdigest()
+    return file_md5.hexdigest(), slo_etag, segment_md5s
+
+
+# Large object hash of the file cut in segments of the given sizes
+def slo_hash(file_path, segment_sizes):
+    segment_md5s = []
+    with open(file_path, 'rb') as f:
+        for segment_size in segment_sizes:
+            segment_md5s.append(hashlib.md5(f.read(segment_size)).hexdigest())
+    return hashlib.md5("".join(segment_md5s).encode()).hexdigest()
+
+
+# Sizes of the segments of a large object read from its manifest, or None for a plain object
+def remote_segment_sizes(conn, container_name, name):
+    endpoint = object_endpoint(container_name, name)
+    response = conn.object_store.head(endpoint)
+    response.raise_for_status()
+    if response.headers.get('X-Static-Large-Object', '').lower() != 'true':
+        return None
+    response = conn.object_store.get(endpoint, params={'multipart-manifest': 'get'})
+    response.raise_for_status()
+    return [segment['bytes'] for segment in response.json()]
+
+
+# Whether the file has the content of the object. A large object is first checked with the local segment size,
+# then with the segment sizes of its manifest (uploaded with another segment size or by another tool)
+def matches_remote_hash(conn, container_name, name, file_path, remote_hash, segment_size):
+    if remote_hash in local_hashes(file_path, segment_size)[:2]:
+        return True
+    segment_sizes = remote_segment_sizes(conn, container_name, name)
+    return segment_sizes is not None and slo_hash(file_path, segment_sizes) == remote_hash
+
+
+def read_segment(file_path, offset, length):
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def print_transfer_summary(action, transferred, skipped, total_bytes, elapsed):
+    speed = total_bytes / elapsed / (1024 * 1024) if elapsed else 0
+    print(f"{action} {transferred} files ({total_bytes / (1024 * 1024):.1f} MB) in {elapsed:.1f}s "
+          f"({speed:.1f} MB/s), {skipped} unchanged files skipped")
+
+
+# Upload the PDF files with a pool of workers. Files already present with the same content are skipped,
+# big files are uploaded by segments, and the segments already uploaded by a previous failed run are kept
+def upload_pdfs(conn, container_name, pdf_path, workers=8, segment_size=32 * 1024 * 1024):
     if os.path.isfile(pdf_path):
         files = [pdf_path]
     elif os.path.isdir(pdf_path):
@@ -37,33 +161,129 @@ def upload_pdfs(conn, container_name, pdf_path):
         print(f"Error: {pdf_path} is neither a file nor a directory")
         return
 
+    start = time.perf_counter()
+    remote = list_remote_objects(conn, container_name)
+    remote_segments = list_remote_objects(conn, segments_container(container_name))
+
+    # Find what needs to be uploaded: (object container, object name, file, offset, length) for each request
+    uploads = []
+    manifests = {}
+    skipped = 0
     for file_path in files:
         filename = os.path.basename(file_path)
-        print(f"Uploading {filename} to container {container_name}...")
-        with open(file_path, 'rb') as f:
-            conn.object_store.upload_object(container=container_name, name=filename, data=f)
-        print(f"{filename} uploaded successfully.")
+        size = os.path.getsize(file_path)
+        file_md5, slo_etag, segment_md5s = local_hashes(file_path, segment_size)
+        if remote.get(filename) == (size, slo_etag if size > segment_size else file_md5):
+            print(f"{filename} is unchanged, skipped.")
+            skipped += 1
+            continue
+        if size <= segment_size:
+            uploads.append((container_name, filename, file_path, 0, size))
+            continue
+
+        # Segment names contain the file size and segment size, so they are only reused for the same file layout
+        manifest = []
+        for i, segment_md5 in enumerate(segment_md5s):
+            offset = i * segment_size
+            length = min(segment_size, size - offset)
+            segment_name = f"{filename}/{size}/{segment_size}/{i:06d}"
+            manifest.append({"path": f"/{segments_container(container_name)}/{segment_name}",
+                             "etag": segment_md5, "size_bytes": length})
+            if remote_segments.get(segment_name, (None, None))[1] != segment_md5:
+                uploads.append((segments_container(container_name), segment_name, file_path, offset, length))
+        manifests[filename] = manifest
+
+    if manifests:
+        conn.object_store.create_container(name=segments_container(container_name))
+
+    def upload(task):
+        target_container, name, file_path, offset, length = task
+        print(f"Uploading {name} to container {target_container}...")
+        conn.object_store.upload_object(container=target_container, name=name,
+                                        data=read_segment(file_path, offset, length))
+        return length
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        total_bytes = sum(executor.map(upload, uploads))
+        # The manifests can only be written once all their segments are uploaded
+        list(executor.map(lambda item: conn.object_store.put(
+            object_endpoint(container_name, item[0]),
+            params={'multipart-manifest': 'put'},
+            data=json.dumps(item[1])).raise_for_status(), manifests.items()))
+
+    print_transfer_summary("Uploaded", len(files) - skipped, skipped, total_bytes, time.perf_counter() - start)
+
+
+# Download an object into local_path, continuing from a previous partial download (the .part file) if any.
+# The ETag of the object is kept next to the .part file, and the range request is conditional on it, so a
+# .part file of an object replaced since is discarded. The file is checked against the hash before being used
+def download_object_resumable(conn, container_name, name, local_path, size, etag, segment_size):
+    part_path = local_path + ".part"
+    etag_path = part_path + ".etag"
+    offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    part_etag = None
+    if os.path.isfile(etag_path):
+        with open(etag_path) as f:
+            part_etag = f.read()
+    if part_etag != etag or offset > size:
+        offset = 0  # partial download of another version of the object
+    with open(etag_path, 'w') as f:
+        f.write(etag)
+    if offset < size:
+        endpoint = object_endpoint(container_name, name)
+        headers = {'Range': f"bytes={offset}-", 'If-Match': f'"{etag}"'} if offset else {}
+        response = conn.object_store.get(endpoint, headers=headers, stream=True)
+        if response.status_code == 412:
+            # The object changed since the listing, restart from zero
+            offset = 0
+            response = conn.object_store.get(endpoint, stream=True)
+        response.raise_for_status()
+        # The server may ignore the range and send the whole object
+        if response.status_code != 206:
+            offset = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for data in response.iter_content(chunk_size=1024 * 1024):
+                f.write(data)
+    if not matches_remote_hash(conn, container_name, name, part_path, etag, segment_size):
+        os.remove(part_path)
+        os.remove(etag_path)
+        raise ValueError(f"{name}: downloaded content doesn't match the object hash {etag}")
+    os.replace(part_path, local_path)
+    os.remove(etag_path)
+    return size - offset
 
 
-def download_pdfs(conn, container_name, download_dir):
+# Download the PDF files with a pool of workers, the files already downloaded with the same content are skipped
+def download_pdfs(conn, container_name, download_dir, workers=8, segment_size=32 * 1024 * 1024):
     # create dir if not exists
     if not os.path.exists(download_dir):
         os.makedirs(download_dir)
 
+    start = time.perf_counter()
     try:
-        objects = conn.object_store.objects(container_name)
-        for obj in objects:
-            if obj.name.endswith(".pdf"):
-                local_path = os.path.join(download_dir, obj.name)
-                print(f"Download {obj.name} in {local_path}...")
-
-                with open(local_path, 'wb') as f:
-                    conn.object_store.download_object(
-                        container=container_name,
-                        obj=obj.name,
-                        output=f
-                    )
-                print(f"{obj.name} downloaded successfully.")
+        remote = {name: info for name, info in list_remote_objects(conn, container_name).items()
+                  if name.endswith(".pdf")}
+        downloads = []
+        for name, (size, remote_hash) in remote.items():
+            local_path = os.path.join(download_dir, name)
+            if os.path.isfile(local_path) and os.path.getsize(local_path) == size \
+                    and matches_remote_hash(conn, container_name, name, local_path, remote_hash, segment_size):
+                print(f"{name} is unchanged, skipped.")
+                continue
+            downloads.append((name, local_path, size, remote_hash))
+
+        def download(task):
+            name, local_path, size, remote_hash = task
+            print(f"Download {name} in {local_path}...")
+            transferred = download_object_resumable(conn, container_name, name, local_path, size,
+                                                    remote_hash, segment_size)
+            print(f"{name} downloaded successfully.")
+            return transferred
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            total_bytes = sum(executor.map(download, downloads))
+        print_transfer_summary("Downloaded", len(downloads), len(remote) - len(downloads),
+                               total_bytes, time.perf_counter() - start)
     except Exception as e:
         print(f"error during pdf download : {e}")
 
@@ -75,24 +295,78 @@ def create_container(conn, container_name):
     public_url = get_container_public_url(conn, container_name)
     print(f"Container '{container_name}' created. Available at '{public_url}'")
 
-def delete_container(conn, container_name):
+# Max number of objects deleted by a single bulk delete request, 0 if the cluster doesn't support bulk delete
+def get_bulk_delete_limit(conn):
+    try:
+        bulk_delete = conn.object_store.get_info().bulk_delete
+    except Exception:
+        return 0
+    if bulk_delete is None:
+        return 0
+    return bulk_delete.get("max_deletes_per_request", 10000)
+
+
+# Delete many objects with a single request of the Swift bulk delete middleware
+# Returns the number of objects deleted (or already missing), and the names that couldn't be deleted
+def bulk_delete_objects(conn, container_name, names):
+    body = "\n".join(urllib.parse.quote(f"/{container_name}/{name}") for name in names)
+    response = conn.object_store.delete("?bulk-delete", data=body,
+                                        headers={'Content-Type': 'text/plain', 'Accept': 'application/json'})
+    result = response.json()
+    prefix = f"/{container_name}/"
+    failed = [urllib.parse.unquote(path)[len(prefix):] for path, _ in result.get("Errors", [])]
+    return result.get("Number Deleted", 0) + result.get("Number Not Found", 0), failed
+
+
+def delete_object(conn, container_name, name):
+    conn.object_store.delete_object(name, container=container_name, ignore_missing=True)
+    return 1
+
+
+# Delete all the objects of a container while listing it: with bulk delete, each page of names is sent
+# as one request, otherwise the objects are deleted one by one by a pool of workers.
+# The objects the bulk delete failed to remove are retried one by one.
+def delete_all_objects(conn, container_name, workers=8):
+    limit = get_bulk_delete_limit(conn)
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if limit:
+            names = (obj.name for obj in conn.object_store.objects(container_name, limit=min(limit, LISTING_PAGE_SIZE)))
+            batches = []
+            batch = []
+            for name in names:
+                batch.append(name)
+                if len(batch) == limit:
+                    batches.append(executor.submit(bulk_delete_objects, conn, container_name, batch))
+                    batch = []
+            if batch:
+                batches.append(executor.submit(bulk_delete_objects, conn, container_name, batch))
+            failed = []
+            for future in batches:
+                count, batch_failed = future.result()
+                deleted += count
+                failed += batch_failed
+        else:
+            failed = [obj.name for obj in conn.object_store.objects(container_name, limit=LISTING_PAGE_SIZE)]
+        deleted += sum(executor.map(lambda name: delete_object(conn, container_name, name), failed))
+    return deleted
+
+
+def delete_container(conn, container_name, workers=8):
     try:
-        # Check if container exists
-        containers = [c for c in conn.object_store.containers() if c.name == container_name]
-        if not containers:
-            print(f"Container '{container_name}' not found.")
-            return
-        container = containers[0]
-
-        # Delete container content
-        objects = list(conn.object_store.objects(container.name))
-        for obj in objects:
-            conn.object_store.delete_object(container=container.name, obj=obj.name)
-            print(f"Deleted object: {obj.name}")
-
-        # Delete container
-        conn.object_store.delete_container(container.name)
-        print(f"Container '{container_name}' deleted successfully.")
+        start = time.perf_counter()
+        # The segments of the large objects are stored in a separate container
+        for name in (container_name, segments_container(container_name)):
+            try:
+                conn.object_store.get_container_metadata(name)
+            except exceptions.NotFoundException:
+                if name == container_name:
+                    print(f"Container '{container_name}' not found.")
+                continue
+            deleted = delete_all_objects(conn, name, workers)
+            conn.object_store.delete_container(name)
+            print(f"Container '{name}' deleted successfully ({deleted} objects).")
+        print(f"Deleted in {time.perf_counter() - start:.1f}s")
 
     except Exception as e:
         print(f"Error deleting container '{container_name}': {e}")
@@ -107,6 +381,8 @@ def load_config():
 config = load_config()
 
 S3_CONTAINER_NAME = config.get('switch', 's3_container_name')
+TRANSFER_WORKERS = config.getint('switch', 'transfer_workers', fallback=8)
+SEGMENT_SIZE = config.getint('switch', 'segment_size_mb', fallback=32) * 1024 * 1024
 
 def main(args):
     # Load speciif config
@@ -119,14 +395,14 @@ def main(args):
     if args.pdf_path:
         # Create container + upload + list
         create_container(conn, S3_CONTAINER_NAME)
-        upload_pdfs(conn, S3_CONTAINER_NAME, args.pdf_path)
+        upload_pdfs(conn, S3_CONTAINER_NAME, args.pdf_path, TRANSFER_WORKERS, SEGMENT_SIZE)
         list_container(conn)
     elif args.list:
-        list_container(conn)
+        list_container(conn, details=args.details or args.verbose, verbose=args.verbose)
     elif args.download:
-        download_pdfs(conn, S3_CONTAINER_NAME, "./s3-download")
+        download_pdfs(conn, S3_CONTAINER_NAME, "./s3-download", TRANSFER_WORKERS, SEGMENT_SIZE)
     elif args.delete:
-        delete_container(conn, S3_CONTAINER_NAME)
+        delete_container(conn, S3_CONTAINER_NAME, TRANSFER_WORKERS)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manage OpenStack Swift containers and PDF files")
@@ -135,6 +411,8 @@ if __name__ == "__main__":
     group.add_argument("--download", action="store_true", help="Download pdf from S3 container")
     group.add_argument("--list", action="store_true", help="List all containers")
     group.add_argument("--delete", action="store_true", help="Delete the container")
+    parser.add_argument("--details", action="store_true", help="With --list, read the objects to compute size statistics")
+    parser.add_argument("--verbose", action="store_true", help="With --list, also print every object")
     args = parser.parse_args()
     main(args)
     
@@ -1,4 +1,8 @@
 import argparse
+import fnmatch
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from openstack import connection
 from openstack.config import OpenStackConfig
 import configparser
@@ -25,69 +29,112 @@ def list_images_dispo(conn):
         print(img.name)
         break
 
-def create_server(conn):
-    print("Create Server:")
-    image = conn.compute.find_image(IMAGE_NAME)
-    flavor = conn.compute.find_flavor(FLAVOR_NAME)
-    network = conn.network.find_network(NETWORK_NAME)
-    keypair = conn.compute.find_keypair(KEYPAIR_NAME)
-    if keypair is None:
-        keypair = conn.compute.create_keypair(name=KEYPAIR_NAME)
-        with open(PRIVATE_KEYPAIR_FILE, "w") as f:
-            f.write(keypair.private_key)
-
-    # Finally create the server and run the VM_SETUP_SCRIPT
-    server = conn.compute.create_server(
-        name=SERVER_NAME,
-        image_id=image.id,
-        flavor_id=flavor.id,
-        networks=[{"uuid": network.id}],
-        key_name=keypair.name,
-    )
-    server = conn.compute.wait_for_server(server)
-    print(f"VM '{SERVER_NAME}' created.")
-
-    # find public network
-    public_net = None
-    for net in conn.network.networks():
-        if "public" in net.name.lower():
-            public_net = net
-            break
-    if public_net is None:
-        raise Exception("Unable to find public network for Floating IP.")
-
-    floating_ip = conn.network.create_ip(floating_network_id=public_net.id)
-
-    # Get VM port
-    ports = list(conn.network.ports(device_id=server.id))
-    if not ports:
-        raise Exception("Unable to find the VM network port")
-    port_id = ports[0].id
-
-    # Link Floating IP
-    conn.network.update_ip(floating_ip, port_id=port_id)
-
-    print(f"You can login with SSH in a minute with\nssh -i {PRIVATE_KEYPAIR_FILE} ubuntu@{floating_ip.floating_ip_address}")
+# Find the public network used for the floating IPs, the external networks are asked to the API first
+def find_public_network(conn):
+    for networks in (conn.network.networks(is_router_external=True), conn.network.networks()):
+        for net in networks:
+            if "public" in net.name.lower():
+                return net
+    raise Exception("Unable to find public network for Floating IP.")
+
+
+# Image, flavor, networks and keypair of the new VMs, resolved once (in parallel) for all of them
+@lru_cache(maxsize=None)
+def get_server_resources(conn):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        image = executor.submit(conn.compute.find_image, IMAGE_NAME)
+        flavor = executor.submit(conn.compute.find_flavor, FLAVOR_NAME)
+        network = executor.submit(conn.network.find_network, NETWORK_NAME)
+        public_net = executor.submit(find_public_network, conn)
+        keypair = conn.compute.find_keypair(KEYPAIR_NAME)
+        if keypair is None:
+            keypair = conn.compute.create_keypair(name=KEYPAIR_NAME)
+            with open(PRIVATE_KEYPAIR_FILE, "w") as f:
+                f.write(keypair.private_key)
+        return image.result(), flavor.result(), network.result(), public_net.result(), keypair
+
+
+# Name of the i-th VM (from 0), the VMs of a fleet are numbered after SERVER_NAME
+def server_name(i, count):
+    return SERVER_NAME if count == 1 else f"{SERVER_NAME}-{i + 1}"
+
+
+# Create count VMs at the same time: the creation requests are sent together, then we wait for
+# all the VMs in parallel, and finally the floating IPs are created directly on the VM ports
+def create_servers(conn, count=1):
+    print(f"Create {count} Server(s):")
+    start = time.perf_counter()
+    image, flavor, network, public_net, keypair = get_server_resources(conn)
+
+    def launch(name):
+        server = conn.compute.create_server(
+            name=name,
+            image_id=image.id,
+            flavor_id=flavor.id,
+            networks=[{"uuid": network.id}],
+            key_name=keypair.name,
+        )
+        server = conn.compute.wait_for_server(server)
+        print(f"VM '{name}' created.")
+        return server
+
+    def attach_floating_ip(server):
+        # Get VM port
+        ports = list(conn.network.ports(device_id=server.id))
+        if not ports:
+            raise Exception(f"Unable to find the network port of VM '{server.name}'")
+        # Create the Floating IP already linked to the port, in a single request
+        return conn.network.create_ip(floating_network_id=public_net.id, port_id=ports[0].id)
+
+    with ThreadPoolExecutor(max_workers=min(count, 16)) as executor:
+        servers = list(executor.map(launch, [server_name(i, count) for i in range(count)]))
+        floating_ips = list(executor.map(attach_floating_ip, servers))
+
+    print(f"{count} VM(s) provisioned in {time.perf_counter() - start:.1f}s")
+    print("You can login with SSH in a minute with")
+    for server, floating_ip in zip(servers, floating_ips):
+        print(f"ssh -i {PRIVATE_KEYPAIR_FILE} ubuntu@{floating_ip.floating_ip_address}  # {server.name}")
 
 def list_servers(conn):
     print("List Servers:")
     for server in conn.compute.servers():
         print(f"{server.name} - {server.status} - {server.id}")
 
+# The servers matching a name, an id, or a shell-style pattern (e.g. "groupd-labo1-*")
+def find_servers(conn, server_name):
+    if not any(c in server_name for c in "*?["):
+        server = conn.compute.find_server(server_name)
+        return [server] if server is not None else []
+    return [server for server in conn.compute.servers() if fnmatch.fnmatchcase(server.name, server_name)]
+
+
+# Floating IPs attached to the ports of a server, filtered by the API
+def find_floating_ips(conn, server):
+    return [fip for port in conn.network.ports(device_id=server.id) for fip in conn.network.ips(port_id=port.id)]
+
+
+# Delete the matching servers and release their floating IPs, everything in parallel,
+# and wait until the servers are really gone
 def delete_server(conn, server_name):
-    server = conn.compute.find_server(server_name)
-    if server is None:
+    servers = find_servers(conn, server_name)
+    if not servers:
         print(f"Server '{server_name}' not found")
         return
-    conn.compute.delete_server(server.id)
-    print(f"Server '{server_name}' deleted")
-    # release floating ip
-    ports = list(conn.network.ports(device_id=server.id))
-    for fip in conn.network.ips():
-        if fip.port_id and fip.port_id in [p.id for p in ports]:
+    start = time.perf_counter()
+
+    def delete(server):
+        # The floating IPs must be found before the server deletion removes its ports
+        floating_ips = find_floating_ips(conn, server)
+        conn.compute.delete_server(server.id)
+        for fip in floating_ips:
             conn.network.delete_ip(fip)
             print(f"Floating IP {fip.floating_ip_address} released")
-# todo make sure it released them all
+        conn.compute.wait_for_delete(server)
+        print(f"Server '{server.name}' deleted")
+
+    with ThreadPoolExecutor(max_workers=min(len(servers), 16)) as executor:
+        list(executor.map(delete, servers))
+    print(f"{len(servers)} VM(s) deleted in {time.perf_counter() - start:.1f}s")
 
 
 if __name__ == "__main__":
@@ -96,7 +143,10 @@ if __name__ == "__main__":
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--list", action="store_true", help="List all VMs")
     group.add_argument("--create", action="store_true", help="Create a new VM")
-    group.add_argument("--delete-vm", type=str, metavar="VM_NAME", help="Delete the VM by id or name")
+    parser.add_argument("--count", type=int, default=1,
+                        help="With --create, number of VMs created in parallel (named <server_name>-1 ... -N)")
+    group.add_argument("--delete-vm", type=str, metavar="VM_NAME",
+                       help="Delete the VM by id or name, or all the VMs matching a pattern like 'groupd-labo1-*'")
     args = parser.parse_args()
 
     # Load specific config
@@ -112,6 +162,6 @@ if __name__ == "__main__":
     if args.list:
         list_servers(conn)
     elif args.create:
-        create_server(conn)
+        create_servers(conn, args.count)
     elif args.delete_vm:
         delete_server(conn, args.delete_vm)
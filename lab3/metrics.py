@@ -0,0 +1,72 @@
+# Prometheus metrics of the chatbot, exported on an HTTP endpoint scraped by Prometheus
+# Every step of a question is timed, with the tokens used by the LLM, the RU charged by Cosmos DB and the cache hits.
+import functools
+import time
+
+from prometheus_client import Counter, Histogram, start_http_server
+
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_seconds", "Duration of each step of a question", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+TOKENS = Counter("chatbot_llm_tokens_total", "Tokens used by the LLM calls", ["kind"])
+COSMOS_REQUEST_CHARGE = Counter("chatbot_cosmos_request_units_total", "Request units charged by Cosmos DB queries")
+CACHE_EVENTS = Counter("chatbot_cache_events_total", "Lookups in the chatbot caches", ["cache", "result"])
+
+
+def start_metrics_server(port):
+    start_http_server(port)
+
+
+# Decorators recording the duration of every call of a function in STAGE_SECONDS
+def timed(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.labels(stage).time():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_async(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.labels(stage).time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# For async generators, the duration is measured until the last item is produced
+def timed_async_generator(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# Count the tokens of a Vertex AI response, when the model reports them
+def record_token_usage(usage_metadata):
+    if usage_metadata is None:
+        return
+    if usage_metadata.prompt_token_count:
+        TOKENS.labels("prompt").inc(usage_metadata.prompt_token_count)
+    if usage_metadata.candidates_token_count:
+        TOKENS.labels("answer").inc(usage_metadata.candidates_token_count)
+
+
+# response_hook for the Cosmos DB SDK, called with the headers of every response
+def record_cosmos_charge(headers, _):
+    COSMOS_REQUEST_CHARGE.inc(float(headers.get('x-ms-request-charge', 0)))
+
+
+def record_cache(cache, hit):
+    CACHE_EVENTS.labels(cache, "hit" if hit else "miss").inc()
@@ -0,0 +1,95 @@
+# In-process vector index, an alternative to the Cosmos DB similarity search for small corpora
+# All the embeddings are kept in a local snapshot (a float32 .npy matrix memory-mapped at load time and
+# a JSON file with the text and source of each row), a query is then a single matrix-vector product.
+# For larger corpora, an optional IVF index (k-means clusters) limits the search to the closest clusters.
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+EMBEDDINGS_FILE = "embeddings.npy"
+DOCUMENTS_FILE = "documents.json"
+
+
+# Write the snapshot of the given documents (dicts with vector_field, id, text, source and page)
+# The snapshot is written in a temporary folder first, so a reader never sees a partial snapshot
+def save_snapshot(snapshot_dir, documents):
+    tmp_dir = snapshot_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    matrix = np.asarray([doc["vector_field"] for doc in documents], dtype=np.float32)
+    np.save(os.path.join(tmp_dir, EMBEDDINGS_FILE), matrix)
+    with open(os.path.join(tmp_dir, DOCUMENTS_FILE), "w") as file:
+        json.dump([{key: doc.get(key) for key in ("id", "text", "source", "page")} for doc in documents], file)
+
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    os.replace(tmp_dir, snapshot_dir)
+
+
+def snapshot_age(snapshot_dir):
+    path = os.path.join(snapshot_dir, EMBEDDINGS_FILE)
+    if not os.path.isfile(path):
+        return None
+    return time.time() - os.path.getmtime(path)
+
+
+# Simple k-means used to build the IVF lists, on a sample of the rows to keep it fast
+def kmeans(matrix, n_clusters, n_iterations=10, sample_size=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = matrix[rng.choice(len(matrix), size=min(sample_size, len(matrix)), replace=False)]
+    centroids = sample[rng.choice(len(sample), size=n_clusters, replace=False)].copy()
+    for _ in range(n_iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for cluster in range(n_clusters):
+            members = sample[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+    return centroids
+
+
+class LocalVectorIndex:
+    # ivf_lists: number of k-means clusters of the IVF index, 0 means exact search over all the rows
+    # ivf_probes: number of closest clusters searched for each query
+    def __init__(self, snapshot_dir, ivf_lists=0, ivf_probes=4):
+        # Memory-mapped, the OS loads the pages of the matrix on demand and shares them between processes
+        self.matrix = np.load(os.path.join(snapshot_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        with open(os.path.join(snapshot_dir, DOCUMENTS_FILE), "r") as file:
+            self.documents = json.load(file)
+        self.ivf_probes = ivf_probes
+        self.centroids = None
+        if ivf_lists and len(self.matrix) > ivf_lists:
+            self.centroids = kmeans(self.matrix, ivf_lists)
+            assignments = np.argmax(self.matrix @ self.centroids.T, axis=1)
+            self.lists = [np.flatnonzero(assignments == cluster) for cluster in range(ivf_lists)]
+
+    def __len__(self):
+        return len(self.documents)
+
+    # Returns the top_k documents with the highest dot product with the query, best first,
+    # in the same format as the Cosmos DB similarity search
+    def search(self, query, top_k=10):
+        if not len(self):
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        if self.centroids is None:
+            rows = None
+            scores = self.matrix @ query
+        else:
+            closest = np.argsort(self.centroids @ query)[::-1][:self.ivf_probes]
+            rows = np.concatenate([self.lists[cluster] for cluster in closest])
+            scores = self.matrix[rows] @ query
+
+        top_k = min(top_k, len(scores))
+        if top_k == 0:
+            return []
+        # argpartition finds the top_k in linear time, only them are sorted
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        results = []
+        for i in best:
+            row = int(i if rows is None else rows[i])
+            results.append({**self.documents[row], "SimilarityScore": float(scores[i])})
+        return results
@@ -1,15 +1,33 @@
 # Based on the app of Abir Chebbi (abir.chebbi@hesge.ch)
 # Modified for the Switch Engine+Azure Cosmos DB+Google Vertex AI
 # Helped by ChatGPT
-from langchain_community.document_loaders import PyPDFDirectoryLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from pypdf import PdfReader
 from google.oauth2 import service_account
 import argparse
-import uuid
+from pathlib import Path
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import tempfile
 import configparser
+import random
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from azure.cosmos import CosmosClient, PartitionKey, exceptions
+from openstack import connection
+from openstack.config import OpenStackConfig
 
-from google.genai import Client
+from google.genai import Client, errors
+import httpx
+from embedding_cache import EmbeddingCache, embed_with_cache
+from context_packing import estimate_tokens
 # The account name is an arbitrary name defined during cosmo db creation
 
 
@@ -34,6 +52,9 @@ PROJECT_ID = config.get('vertexai', 'project_id')
 AI_MODEL_EMBEDDINGS = config.get('vertexai', 'ai_model_embeddings')
 AI_MODEL_FINAL_PROMPT = config.get('vertexai', 'ai_model_final_prompt')
 
+EMBEDDING_CACHE_FILE = config.get('cache', 'embedding_cache_file', fallback='embedding-cache.sqlite')
+EMBEDDING_CACHE_MAX_MB = config.getint('cache', 'embedding_cache_max_mb', fallback=512)
+
 ai_vectors_dimensions = 768  # kinda arbitrary value
 
 # This implementation is based on https://docs.azure.cn/en-us/cosmos-db/nosql/how-to-python-vector-index-query#enable-the-feature
@@ -81,88 +102,434 @@ def create_cosmos_db_container(container_name, account_name):
         raise
 
 
-# Load docs from S3
-# TODO: convert to download from switch engine bucket !
-# and enable again in main()
-#
-# def download_documents(bucket_name, local_dir):
-#     response = s3_client.list_objects_v2(Bucket=bucket_name)
-#     for item in response['Contents']:
-#         key = item['Key']
-#         if key.endswith('.pdf'):
-#             local_filename = os.path.join(local_dir, key)
-#             s3_client.download_file(
-#                 Bucket=bucket_name, Key=key, Filename=local_filename)
-
-
-# Split pages/text into chunks
-def split_text(docs, chunk_size, chunk_overlap):
+# Read the PDF files straight from the Switch engine object storage (Swift), without a separate
+# download step (manage-S3_switch.py --download) nor a copy of the library on disk
+def get_swift_connection():
+    cloud = OpenStackConfig(config_files=[config.get('switch', 'clouds_yaml')]).get_one("engines")
+    return connection.Connection(config=cloud)
+
+
+# Path of a temporary copy of a PDF file, deleted by iter_chunks() once all its pages are parsed
+class SpilledPdf(str):
+    pass
+
+
+# Download the PDF objects of a Swift container with a pool of threads, while the previous ones are parsed
+# Yields (source, data) in the order of the container listing: data is the content of the object in memory,
+# or a SpilledPdf in spill_dir for the objects bigger than spill_size
+# spill_dir must be kept until the end of the ingestion, the last files are still parsed after this generator ends
+def iter_swift_pdfs(conn, container_name, spill_dir, download_workers=4, spill_size=64 * 1024 * 1024):
+    objects = [obj for obj in conn.object_store.objects(container_name) if obj.name.endswith(".pdf")]
+    print(f"{len(objects)} PDF files found in the Swift container {container_name}")
+
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        def download(obj):
+            stream = conn.object_store.stream_object(obj.name, container=container_name, chunk_size=1024 * 1024)
+            if (obj.content_length or 0) <= spill_size:
+                return b"".join(stream)
+            spill_file = os.path.join(spill_dir, hashlib.sha256(obj.name.encode('utf-8')).hexdigest() + ".pdf")
+            with open(spill_file, 'wb') as file:
+                for data in stream:
+                    file.write(data)
+            return SpilledPdf(spill_file)
+
+        # Only a few files ahead of the one being parsed are downloaded, to keep the memory bounded
+        pending = deque()
+        for obj in objects:
+            pending.append((obj.name, executor.submit(download, obj)))
+            if len(pending) >= download_workers * 2:
+                name, future = pending.popleft()
+                yield f"swift://{container_name}/{name}", future.result()
+        while pending:
+            name, future = pending.popleft()
+            yield f"swift://{container_name}/{name}", future.result()
+
+
+# The PDF files found in local_path, with the same glob pattern PyPDFDirectoryLoader uses
+def list_pdf_files(local_path):
+    return sorted(str(path) for path in Path(local_path).glob("**/[!.]*.pdf") if path.is_file())
+
+
+# Same (source, data) pairs as iter_swift_pdfs() for the local files, the data is the file path
+def iter_local_pdfs(local_path):
+    for pdf_file in list_pdf_files(local_path):
+        yield pdf_file, pdf_file
+
+
+# data is either the path of a PDF file or its content
+def open_pdf(data):
+    return PdfReader(io.BytesIO(data) if isinstance(data, bytes) else data)
+
+
+# Number of pages parsed by a single task, so big PDF files are also parsed by several processes
+PAGES_PER_TASK = 20
+
+
+# The parsing tasks (source, pdf data, first page, end page excluded) of all the given (source, data) PDF files
+# A PDF held in memory is a single task (end page None), as the content of the file is sent to the worker
+# process with each task; only the files on disk are split by page ranges.
+# Each task comes with the SpilledPdf to delete once its chunks are consumed (the last task of the file), or None
+def list_parse_tasks(pdfs, pages_per_task=PAGES_PER_TASK):
+    for source, data in pdfs:
+        if isinstance(data, bytes):
+            yield (source, data, 0, None), None
+            continue
+        n_pages = len(open_pdf(data).pages)
+        for start in range(0, n_pages, pages_per_task):
+            end = min(start + pages_per_task, n_pages)
+            spilled = data if isinstance(data, SpilledPdf) and end == n_pages else None
+            yield (source, str(data), start, end), spilled
+
+
+# Extract the text of the pages of a task and split them into chunks, with the same metadata as PyPDFLoader
+# This runs in a worker process, the arguments and the result are sent between processes
+def load_and_split(task, chunk_size, chunk_overlap):
+    source, data, start, end = task
+    reader = open_pdf(data)
+    if end is None:
+        end = len(reader.pages)
+    pages = [Document(page_content=reader.pages[i].extract_text(), metadata={'source': source, 'page': i})
+             for i in range(start, end)]
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    chunks = text_splitter.split_documents(docs)
-
-    return chunks
-
-
-# Generate embedding with Google Vertex AI from given chunks of the PDF
-def generate_embeddings(chunks):
-    chunks_list = [chunk.page_content for chunk in chunks]
-
-    # Batch embeddings (Vertex AI supports batching up to 100 texts per request)
-    embeddings = []
-    batch_size = 100
+    return text_splitter.split_documents(pages)
+
+
+# Lazily load the PDFs (iterable of (source, data)) by page ranges and split them as soon as they are read,
+# so we never hold the whole library in memory (PyPDFDirectoryLoader.lazy_load() loads everything)
+# With several workers, the page ranges are parsed in parallel by a pool of processes,
+# the chunks are still yielded in the same order as with a single worker
+# The processes are started from a fork server: this runs in a thread of the pipeline, and forking a process
+# while the other threads hold locks (embedding workers, upserts, SQLite cache) can deadlock the children
+# A spilled Swift object is deleted as soon as its last page range is parsed, so only a few are on disk at once
+def iter_chunks(pdfs, chunk_size, chunk_overlap, workers=1):
+    tasks = list_parse_tasks(pdfs)
+    if workers <= 1:
+        for task, spilled in tasks:
+            yield from load_and_split(task, chunk_size, chunk_overlap)
+            if spilled:
+                os.remove(spilled)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as executor:
+        # Only a few tasks ahead of the one being consumed are submitted, to keep the memory bounded
+        pending = deque()
+
+        def consume_oldest():
+            future, spilled = pending.popleft()
+            yield from future.result()
+            if spilled:
+                os.remove(spilled)
+
+        for task, spilled in tasks:
+            pending.append((executor.submit(load_and_split, task, chunk_size, chunk_overlap), spilled))
+            if len(pending) >= workers * 2:
+                yield from consume_oldest()
+        while pending:
+            yield from consume_oldest()
+
+
+# Group the items of an iterable into lists of at most batch_size items
+# When max_tokens is given, a batch is also closed before its estimated token count goes above it,
+# so batches of long texts are smaller than batches of short ones
+def batched(iterable, batch_size, max_tokens=None, text_of=lambda item: item):
+    batch = []
+    batch_tokens = 0
+    for item in iterable:
+        tokens = estimate_tokens(text_of(item)) if max_tokens else 0
+        if batch and max_tokens and batch_tokens + tokens > max_tokens:
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(item)
+        batch_tokens += tokens
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+            batch_tokens = 0
+    if batch:
+        yield batch
+
+
+# Budget of requests and tokens per minute shared by all the embedding workers,
+# over a sliding window of 60 seconds. A limit of 0 disables it.
+class RateLimiter:
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = deque()  # (timestamp, tokens) of the requests sent in the last minute
+        self.window_tokens = 0
+        self.lock = threading.Lock()
+
+    # Block until a request of the given number of tokens fits in the budget
+    def acquire(self, tokens):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.window and self.window[0][0] <= now - 60:
+                    self.window_tokens -= self.window.popleft()[1]
+                fits_requests = not self.requests_per_minute or len(self.window) < self.requests_per_minute
+                # A single request bigger than the whole budget is let through when the window is empty
+                fits_tokens = (not self.tokens_per_minute or not self.window
+                               or self.window_tokens + tokens <= self.tokens_per_minute)
+                if fits_requests and fits_tokens:
+                    self.window.append((now, tokens))
+                    self.window_tokens += tokens
+                    return
+                wait_time = self.window[0][0] + 60 - now
+            time.sleep(max(wait_time, 0.01))
+
+
+def get_vertex_ai_client():
     scopes = ['https://www.googleapis.com/auth/cloud-platform']
     creds = service_account.Credentials.from_service_account_file(
         "vertexai-service-account-key.json", scopes=scopes)
-    client = Client(
+    return Client(
         vertexai=True, project=PROJECT_ID, location=VERTEXAI_REGION, credentials=creds)
 
-    for i in range(0, len(chunks_list), batch_size):
-        batch = chunks_list[i:i+batch_size]
-        batch_embeddings = client.models.embed_content(
-            model=AI_MODEL_EMBEDDINGS,
-            contents=batch,
-            # config=EmbedContentConfig(
-            #     task_type="RETRIEVAL_DOCUMENT",  # Optional
-            #     output_dimensionality=1000,  # Optional
-            #     title="Driver's License",  # Optional
-            # ),
-        )
-        print(batch_embeddings)
-        # Convert to list of floats
-        embeddings.extend([e.values for e in batch_embeddings.embeddings])
-
-    # Debug: Print actual embedding dimensions
-    if embeddings:
-        actual_dimension = len(embeddings[0])
-        print(f"Actual embedding dimension: {actual_dimension}")
-        if actual_dimension != 768:
-            print(f"WARNING: Embedding dimension ({
-                  actual_dimension}) doesn't match index dimension (768)")
-
-    return embeddings
-
-
-# Store generated embeddings into a Cosmos DB
-def store_embeddings_cosmos(embeddings, texts, meta_data_list, account_name, database_name, container_name):
+
+# HTTP status codes of Vertex AI errors worth retrying: quota exceeded and temporary server errors
+TRANSIENT_ERROR_CODES = {429, 500, 502, 503, 504}
+
+
+# Embed a single batch of texts, Vertex AI supports batching up to 100 texts per request
+# Transient failures are retried with a jittered exponential backoff
+def embed_texts(client, texts, limiter=None, max_retries=5):
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire(sum(estimate_tokens(text) for text in texts))
+        try:
+            batch_embeddings = client.models.embed_content(
+                model=AI_MODEL_EMBEDDINGS,
+                contents=texts,
+                # config=EmbedContentConfig(
+                #     task_type="RETRIEVAL_DOCUMENT",  # Optional
+                #     output_dimensionality=1000,  # Optional
+                #     title="Driver's License",  # Optional
+                # ),
+            )
+            # Convert to list of floats
+            return [e.values for e in batch_embeddings.embeddings]
+        # google-genai sends its requests with httpx: connection failures and timeouts are httpx.TransportError
+        except (errors.APIError, httpx.TransportError) as e:
+            if attempt == max_retries or (isinstance(e, errors.APIError) and e.code not in TRANSIENT_ERROR_CODES):
+                raise
+            delay = random.uniform(0, min(60, 2 ** attempt))
+            print(f"Embedding request failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# Same as embed_texts() but the texts already embedded in a previous run are taken from the cache
+def embed_texts_cached(client, cache, texts, limiter=None):
+    if cache is None:
+        return embed_texts(client, texts, limiter)
+    return embed_with_cache(cache, AI_MODEL_EMBEDDINGS, texts,
+                            lambda missing: embed_texts(client, missing, limiter))
+
+
+# Send a Cosmos DB request, retrying with backoff when Cosmos DB throttles us (HTTP 429)
+# request is called with the response_hook to give to the SDK
+# Returns the RU charge of the successful request
+def with_backoff(request, max_retries=8):
+    charge = []
+    for attempt in range(max_retries + 1):
+        try:
+            request(lambda headers, _: charge.append(float(headers.get('x-ms-request-charge', 0))))
+            return charge[-1] if charge else 0.0
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code != 429 or attempt == max_retries:
+                raise
+            # Cosmos DB tells us how long to wait, otherwise use a jittered exponential backoff
+            retry_after_ms = (e.headers or {}).get('x-ms-retry-after-ms')
+            delay = float(retry_after_ms) / 1000 if retry_after_ms else 0.1 * 2 ** attempt
+            time.sleep(delay + random.uniform(0, delay / 2))
+
+
+def upsert_with_backoff(container, doc):
+    return with_backoff(lambda hook: container.upsert_item(doc, response_hook=hook))
+
+
+# Delete a document, it's fine if it was already deleted
+def delete_with_backoff(container, doc_id):
+    try:
+        return with_backoff(lambda hook: container.delete_item(
+            item=doc_id, partition_key=doc_id, response_hook=hook))
+    except exceptions.CosmosResourceNotFoundError:
+        return 0.0
+
+
+def get_cosmos_container(account_name, database_name, container_name):
     client = get_cosmos_client(account_name)
     database = client.get_database_client(database_name)
-    container = database.get_container_client(container_name)
+    return database.get_container_client(container_name)
+
 
-    documents = []
-    for i, (embedding, text, metadata) in enumerate(zip(embeddings, texts, meta_data_list)):
-        doc = {
-            "id": str(uuid.uuid4()),
-            "vector_field": embedding,
-            "text": text,
-            **metadata  # merge metadata keys directly into the doc
-        }
-        documents.append(doc)
+# Deterministic id of a chunk, based on its source file, page and content
+# Running the ingestion twice on the same files gives the same ids, so documents are overwritten instead of duplicated
+def chunk_id(source, page, text):
+    content_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return hashlib.sha256(f"{source}\0{page}\0{content_hash}".encode('utf-8')).hexdigest()
 
-    for doc in documents:
-        container.upsert_item(doc)
 
-    return f"{len(documents)} documents upserted into Cosmos DB"
+def make_document(embedding, text, metadata):
+    return {
+        "id": chunk_id(metadata['source'], metadata['page'], text),
+        "vector_field": embedding,
+        "text": text,
+        **metadata  # merge metadata keys directly into the doc
+    }
+
+
+# Upsert batches of documents as they arrive. The upserts are sent concurrently by a bounded
+# pool of workers, as every document lives in its own logical partition (the container is
+# partitioned on /id). We stop pulling new batches while too many upserts are in flight.
+def upsert_batches(container, batches, concurrency=16):
+    start = time.perf_counter()
+    total_docs = 0
+    total_ru = 0.0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for documents in batches:
+            pending.update(executor.submit(upsert_with_backoff, container, doc) for doc in documents)
+            while len(pending) > concurrency * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                total_ru += sum(future.result() for future in done)
+                total_docs += len(done)
+        done, _ = wait(pending)
+        total_ru += sum(future.result() for future in done)
+        total_docs += len(done)
+    elapsed = time.perf_counter() - start
+
+    print(f"Upserted {total_docs} documents in {elapsed:.1f}s "
+          f"({total_docs / elapsed if elapsed else 0:.1f} docs/s, {total_ru:.1f} RU consumed)")
+    return total_docs
+
+
+# Delete the given document ids with the same bounded pool of workers as the upserts
+def delete_documents(container, doc_ids, concurrency=16):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        total_ru = sum(executor.map(lambda doc_id: delete_with_backoff(container, doc_id), doc_ids))
+    print(f"Deleted {len(doc_ids)} outdated documents ({total_ru:.1f} RU consumed)")
+
+
+# The manifest remembers which chunk ids of each source file are already stored in Cosmos DB
+# Format: {"source file path": ["chunk id", ...]}
+def load_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file, 'r') as file:
+        return json.load(file)
+
+
+def save_manifest(manifest_file, manifest):
+    # Write to a temporary file first, so a crash never leaves a truncated manifest
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_file, manifest_file)
+
+
+# True if the source (a chunk 'source' metadata) was read from the given local path, or from the Swift container
+def source_in_scope(source, local_path, swift_container=None):
+    if swift_container:
+        return source.startswith(f"swift://{swift_container}/")
+    return not source.startswith("swift://") and Path(source).resolve().is_relative_to(Path(local_path).resolve())
+
+
+# Merge the chunk ids seen during a run into the manifest of the previous runs
+# Without deleted_sources (nothing was deleted from Cosmos DB), the ids of the previous run are kept as well,
+# as these documents are still stored. With them, the ids of a seen source are replaced by the new ones,
+# and the deleted sources are removed.
+def merge_manifest(manifest, seen, deleted_sources=None):
+    merged = {source: ids for source, ids in manifest.items() if source not in (deleted_sources or ())}
+    for source, ids in seen.items():
+        previous = [] if deleted_sources is not None else merged.get(source, [])
+        merged[source] = list(dict.fromkeys(previous + ids))
+    return merged
+
+
+# Run a pipeline stage in background threads: every item taken from inbox is given to func
+# and its result is put in outbox. None marks the end of the stream and is forwarded as well.
+# The queues are bounded, so a slow stage makes the previous ones wait instead of piling up data.
+# With several workers, up to `workers` items are processed at the same time (in no particular order).
+# After an error (in errors), the workers keep taking the items without processing them until the end marker,
+# so the producer never stays blocked on a full inbox, and it is expected to stop as soon as errors is not empty.
+def start_stage(func, inbox, outbox, errors, workers=1):
+    running = [workers]
+    lock = threading.Lock()
+
+    def run():
+        while (item := inbox.get()) is not None:
+            if errors:
+                continue
+            try:
+                outbox.put(func(item))
+            except Exception as e:
+                errors.append(e)
+        # Give the end marker back for the other workers (the producer is done), the last one forwards it
+        inbox.put(None)
+        with lock:
+            running[0] -= 1
+            if running[0] == 0:
+                outbox.put(None)
+
+    threads = [threading.Thread(target=run, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# Drain a queue until the end of stream marker
+def iter_queue(q):
+    while (item := q.get()) is not None:
+        yield item
+
+
+# Streaming ingestion: load page -> split -> embed batch -> upsert batch
+# pdfs are the (source, data) pairs of iter_local_pdfs() or iter_swift_pdfs()
+# Each step runs concurrently with the others, so the first documents are stored after a few seconds
+# Chunks whose id is in skip_ids are already stored and are not embedded again
+# Returns the number of stored documents and the chunk ids seen for each source file
+def ingest_streaming(pdfs, container, concurrency=16, batch_size=100, queue_size=4, skip_ids=frozenset(), cache=None,
+                     embedding_workers=4, max_batch_tokens=None, limiter=None, parse_workers=1):
+    client = get_vertex_ai_client()
+    errors = []
+    seen = {}
+    chunk_batches = queue.Queue(maxsize=queue_size)
+    embedded_batches = queue.Queue(maxsize=queue_size)
+
+    def new_chunks():
+        for chunk in iter_chunks(pdfs, 1000, 100, parse_workers):
+            source = chunk.metadata['source']
+            doc_id = chunk_id(source, chunk.metadata['page'] + 1, chunk.page_content)
+            seen.setdefault(source, []).append(doc_id)
+            if doc_id not in skip_ids:
+                yield chunk
+
+    def load_chunks():
+        try:
+            for batch in batched(new_chunks(), batch_size, max_batch_tokens, lambda chunk: chunk.page_content):
+                # Stop reading the files when a later stage failed
+                if errors:
+                    break
+                chunk_batches.put(batch)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            chunk_batches.put(None)
+
+    def embed_chunks(chunks):
+        embeddings = embed_texts_cached(client, cache, [chunk.page_content for chunk in chunks], limiter)
+        return [make_document(embedding, chunk.page_content,
+                              {'source': chunk.metadata['source'], 'page': chunk.metadata['page'] + 1})
+                for chunk, embedding in zip(chunks, embeddings)]
+
+    threading.Thread(target=load_chunks, daemon=True).start()
+    start_stage(embed_chunks, chunk_batches, embedded_batches, errors, embedding_workers)
+    total_docs = upsert_batches(container, iter_queue(embedded_batches), concurrency)
+    if errors:
+        raise errors[0]
+    return total_docs, seen
 
 
 def load_config():
@@ -176,45 +543,75 @@ config = load_config()
 REGION = config.get('azure', 'region')
 ACCOUNT_NAME = config.get('azure', 'account_name')
 AZURE_CONTAINER_NAME = config.get('azure', 'container_name')
+UPSERT_CONCURRENCY = config.getint('ingestion', 'upsert_concurrency', fallback=16)
+EMBEDDING_BATCH_SIZE = config.getint('ingestion', 'embedding_batch_size', fallback=100)
+PIPELINE_QUEUE_SIZE = config.getint('ingestion', 'pipeline_queue_size', fallback=4)
+EMBEDDING_WORKERS = config.getint('ingestion', 'embedding_workers', fallback=4)
+EMBEDDING_MAX_BATCH_TOKENS = config.getint('ingestion', 'embedding_max_batch_tokens', fallback=20000)
+EMBEDDING_REQUESTS_PER_MINUTE = config.getint('ingestion', 'embedding_requests_per_minute', fallback=0)
+EMBEDDING_TOKENS_PER_MINUTE = config.getint('ingestion', 'embedding_tokens_per_minute', fallback=0)
+MANIFEST_FILE = config.get('ingestion', 'manifest_file', fallback='ingest-manifest.json')
+SWIFT_CONTAINER_NAME = config.get('switch', 's3_container_name')
+SWIFT_DOWNLOAD_WORKERS = config.getint('ingestion', 'swift_download_workers', fallback=4)
+SWIFT_SPILL_SIZE_MB = config.getint('ingestion', 'swift_spill_size_mb', fallback=64)
 
 # main
-def main(local_path):
-
-    # TODO enable that again
-    # download_documents(bucket_name, local_path)
-    loader = PyPDFDirectoryLoader(local_path)
-    docs = loader.load()
-    print('Start chunking')
-    chunks = split_text(docs, 1000, 100)
-    print(chunks[1])
+def main(local_path, incremental, workers, swift_container=None):
+    spill_dir = tempfile.TemporaryDirectory()
+    if swift_container:
+        pdfs = iter_swift_pdfs(get_swift_connection(), swift_container, spill_dir.name, SWIFT_DOWNLOAD_WORKERS,
+                               SWIFT_SPILL_SIZE_MB * 1024 * 1024)
+    else:
+        pdfs = iter_local_pdfs(local_path)
     create_cosmos_db_container(AZURE_CONTAINER_NAME, ACCOUNT_NAME)
-    print('Start vectorising')
-    embeddings = generate_embeddings(chunks)
-    print(embeddings[1])
-    texts = [chunk.page_content for chunk in chunks]
-    # Prepare metadata for each chunk
-    meta_data = [{'source': chunk.metadata['source'],
-                  'page': chunk.metadata['page'] + 1} for chunk in chunks]
-    print('Start storing')
-    print(f"Storing {len(embeddings)} embeddings in batches...")
+    container = get_cosmos_container(ACCOUNT_NAME, ACCOUNT_NAME, AZURE_CONTAINER_NAME)
+    print('Start streaming ingestion (chunking, vectorising and storing)')
+
+    manifest = load_manifest(MANIFEST_FILE)
+    stored_ids = {doc_id for ids in manifest.values() for doc_id in ids}
+    if incremental:
+        print(f"Incremental mode: {len(stored_ids)} chunks already stored will be skipped")
 
     try:
-        store_embeddings_cosmos(
-            embeddings,
-            texts,
-            meta_data,
-            ACCOUNT_NAME,
-            database_name=ACCOUNT_NAME,
-            container_name=AZURE_CONTAINER_NAME,
-        )
+        _, seen = ingest_streaming(pdfs, container,
+                                   concurrency=UPSERT_CONCURRENCY,
+                                   batch_size=EMBEDDING_BATCH_SIZE,
+                                   queue_size=PIPELINE_QUEUE_SIZE,
+                                   skip_ids=stored_ids if incremental else frozenset(),
+                                   cache=EmbeddingCache(EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_MB * 1024 * 1024),
+                                   embedding_workers=EMBEDDING_WORKERS,
+                                   max_batch_tokens=EMBEDDING_MAX_BATCH_TOKENS,
+                                   limiter=RateLimiter(EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE),
+                                   parse_workers=workers)
+        if incremental:
+            # Chunks of removed files, or that changed in modified files, are not valid anymore
+            # Only the files of this local_path / container are considered, the other ones were not read
+            scoped_sources = {source for source in manifest if source_in_scope(source, local_path, swift_container)}
+            scoped_ids = {doc_id for source in scoped_sources for doc_id in manifest[source]}
+            outdated_ids = scoped_ids - {doc_id for ids in seen.values() for doc_id in ids}
+            if outdated_ids:
+                delete_documents(container, list(outdated_ids), UPSERT_CONCURRENCY)
+            manifest = merge_manifest(manifest, seen, deleted_sources=scoped_sources - set(seen))
+        else:
+            manifest = merge_manifest(manifest, seen)
+        save_manifest(MANIFEST_FILE, manifest)
         print('End storing - Success!')
     except Exception as e:
         print(f"Error storing embeddings: {e}")
+    finally:
+        spill_dir.cleanup()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Process PDF documents and store their embeddings.")
     parser.add_argument("--local_path", help="local path")
+    parser.add_argument("--swift_container", nargs="?", const=SWIFT_CONTAINER_NAME,
+                        help="Read the PDF files directly from this Swift container instead of local_path "
+                             f"(default: {SWIFT_CONTAINER_NAME})")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only embed and store new or changed chunks, based on the manifest of the previous run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes parsing and chunking the PDF files (default: number of CPUs)")
     args = parser.parse_args()
-    main(args.local_path)
+    main(args.local_path, args.incremental, args.workers, args.swift_container)
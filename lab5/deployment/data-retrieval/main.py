@@ -1,16 +1,50 @@
 import boto3
 import pandas as pd
 import redis
-from io import StringIO
+from botocore.config import Config
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 import numpy
-import csv
 import logging
 import os 
+import time
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 
+# Samples sent by a single TS.MADD command, commands sent in a single pipeline round trip,
+# and number of Redis connections sending pipelines in parallel
+TS_CHUNK_SIZE = int(os.getenv('TS_CHUNK_SIZE', 1000))
+PIPELINE_COMMANDS = int(os.getenv('PIPELINE_COMMANDS', 16))
+WRITER_CONNECTIONS = int(os.getenv('WRITER_CONNECTIONS', 4))
+
+# The CSV is downloaded by byte ranges of RANGE_SIZE_MB, DOWNLOAD_WORKERS at a time, and parsed while downloaded
+# When CSV_CACHE_DIR is set, the downloaded CSV is kept there and reused while its ETag doesn't change
+# S3_ENDPOINT_URL allows to use another S3 service, like a local MinIO
+RANGE_SIZE = int(os.getenv('RANGE_SIZE_MB', 8)) * 1024 * 1024
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 8))
+CSV_CACHE_DIR = os.getenv('CSV_CACHE_DIR', '')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL') or None
+
+# The job is incremental: the last timestamp written for each device (its checkpoint) and the ETag of the
+# last CSV fully ingested are kept in Redis, so a rerun only writes the new samples, or nothing at all.
+# FULL_RELOAD=1 ignores them and writes all the samples again.
+CHECKPOINTS_KEY = "data_retrieval:checkpoints"
+ENQUEUED_KEY = "data_retrieval:enqueued"
+INGESTED_ETAG_KEY = "data_retrieval:ingested_etag"
+FULL_RELOAD = os.getenv('FULL_RELOAD', '0') == '1'
+
+# Push a device on the queue of the forecasters, only if it has never been pushed before
+ENQUEUE_ONCE_SCRIPT = """
+if redis.call('SADD', KEYS[1], ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[2], ARGV[1])
+end
+"""
+
 
 def check_redis_connection():
     try:
@@ -33,49 +67,269 @@ def check_redis_connection():
 
 
 
+def read_csv_frames(csv_file, n_col=11, columns=None, chunksize=100_000):
+    """Reads the semicolon CSV (a DATETIME column, then one column per device) by chunks of rows.
+
+    The device columns are parsed as float32. Without columns, csv_file starts with the header line;
+    with columns, csv_file only holds measurement lines, which get these column names.
+    """
+    usecols = range(n_col) if n_col else None
+    if columns is None:
+        # The line after the header doesn't hold measurements
+        return pd.read_csv(csv_file, sep=';', skiprows=[1], usecols=usecols,
+                           dtype=defaultdict(lambda: numpy.float32, DATETIME=str), chunksize=chunksize)
+    frames = pd.read_csv(csv_file, sep=';', header=None, usecols=usecols,
+                         dtype=defaultdict(lambda: numpy.float32, {0: str}), chunksize=chunksize)
+    return (frame.set_axis(columns, axis=1) for frame in frames)
+
+
+def frame_arrays(frame):
+    """Returns the timestamps (epoch milliseconds) and the {device_id: values} arrays of a chunk of rows."""
+    # datetime64[ms] since epoch, naive datetimes are taken as UTC like pd.Timestamp.timestamp()
+    timestamps = pd.to_datetime(frame["DATETIME"]).to_numpy(dtype="datetime64[ms]").astype(numpy.int64)
+    return timestamps, {device_id: frame[device_id].to_numpy() for device_id in frame.columns[1:]}
+
+
+def combine_device_series(parts):
+    """Concatenates the (timestamps, {device_id: values}) parts, in order, into {device_id: (timestamps, values)}.
+
+    The DATETIME column is converted once for all the devices, and the missing values are dropped.
+    """
+    timestamp_chunks = []
+    value_chunks = defaultdict(list)
+    for timestamps, values in parts:
+        timestamp_chunks.append(timestamps)
+        for device_id, device_values in values.items():
+            value_chunks[device_id].append(device_values)
+
+    timestamps = numpy.concatenate(timestamp_chunks) if timestamp_chunks else numpy.empty(0, dtype=numpy.int64)
+    devices = {}
+    for device_id, chunks in value_chunks.items():
+        values = numpy.concatenate(chunks)
+        present = ~numpy.isnan(values)
+        # The timestamps are shared by all the devices without missing values
+        devices[device_id] = (timestamps, values) if present.all() else (timestamps[present], values[present])
+    return devices
+
+
+def parse_lines(data, n_col, columns):
+    """Parses a block of complete CSV lines, the first block (columns is None) starts with the header."""
+    if not data.strip():
+        return []
+    return [frame_arrays(frame) for frame in read_csv_frames(BytesIO(data), n_col, columns)]
+
+
+def load_device_series_by_ranges(read_range, size, n_col=11, range_size=RANGE_SIZE, workers=DOWNLOAD_WORKERS):
+    """Parses the semicolon CSV into per-device NumPy arrays: {device_id: (timestamps, values)}.
+
+    The file of the given size is read by byte ranges in parallel with read_range(start, end), the ranges
+    being parsed while the next ones are read. The device columns are float32, the timestamps int64 epoch ms.
+
+    The ranges are cut at line boundaries before being parsed: the beginning of a range, up to its first
+    new line, is the end of the last line of the previous range. The lines must be shorter than range_size.
+    Only a few ranges ahead of the one being parsed are read, to keep the memory bounded.
+    """
+    ranges = iter([(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)])
+    with ThreadPoolExecutor(max_workers=workers) as download_executor, \
+            ThreadPoolExecutor(max_workers=workers) as parse_executor:
+        downloads = deque(download_executor.submit(read_range, *byte_range)
+                          for byte_range in islice(ranges, workers * 2))
+        parsed = []
+        columns = None
+        tail = b""
+        while downloads:
+            data = downloads.popleft().result()
+            for byte_range in islice(ranges, 1):
+                downloads.append(download_executor.submit(read_range, *byte_range))
+
+            # Cut the range after its last complete line, the rest goes with the next range
+            end = data.rfind(b"\n") + 1 if downloads else len(data)
+            lines, tail = tail + data[:end], data[end:]
+            parsed.append(parse_executor.submit(parse_lines, lines, n_col, columns))
+            if columns is None:
+                header = lines[:lines.index(b"\n")].decode('utf-8').rstrip("\r").split(';')
+                columns = header[:n_col] if n_col else header
+            # Don't read further while too many ranges are waiting to be parsed
+            if len(parsed) > workers * 2:
+                parsed[-workers * 2 - 1].result()
+        return combine_device_series(part for future in parsed for part in future.result())
+
+
 def read_partial_csv(bucket_name, object_name, n_col=11):
-    """Reads a CSV from S3, yielding rows with the specified number of columns."""
+    """Reads a CSV from S3 into per-device arrays, keeping only the specified number of columns.
+
+    The object is downloaded by byte ranges in parallel. With CSV_CACHE_DIR, it is also written to a local
+    file named after its ETag, which is read instead of S3 as long as the object doesn't change.
+    """
 
     logger.info(f"Reading CSV from S3 bucket: {bucket_name}")
-    response = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+    head = s3_client.head_object(Bucket=bucket_name, Key=object_name)
+    size = head['ContentLength']
+
+    cache_file = None
+    if CSV_CACHE_DIR:
+        cache_name = object_name.replace('/', '_')
+        etag = head['ETag'].strip('"')
+        cache_file = os.path.join(CSV_CACHE_DIR, f"{cache_name}.{etag}")
+        if os.path.isfile(cache_file):
+            logger.info(f"Reading CSV from the local cache: {cache_file}")
+            with open(cache_file, 'rb') as file:
+                return load_device_series_by_ranges(
+                    lambda start, end: os.pread(file.fileno(), end - start + 1, start), size, n_col)
+        os.makedirs(CSV_CACHE_DIR, exist_ok=True)
+
+    with open(cache_file + ".part", 'wb') if cache_file else nullcontext() as cache:
+        def read_range(start, end):
+            # IfMatch: all the ranges must come from the same version of the object
+            response = s3_client.get_object(Bucket=bucket_name, Key=object_name, Range=f"bytes={start}-{end}",
+                                            IfMatch=head['ETag'])
+            data = response['Body'].read()
+            if cache:
+                os.pwrite(cache.fileno(), data, start)
+            return data
+
+        devices = load_device_series_by_ranges(read_range, size, n_col)
+
+    if cache_file:
+        os.replace(cache_file + ".part", cache_file)
+        # The previous versions of the object are not needed anymore
+        for file in os.listdir(CSV_CACHE_DIR):
+            if file.startswith(f"{cache_name}.") and os.path.join(CSV_CACHE_DIR, file) != cache_file:
+                os.remove(os.path.join(CSV_CACHE_DIR, file))
+    return devices
+
+
+def madd_command(series, timestamps, values):
+    """Builds the TS.MADD command writing the given samples to a series."""
+    # The shortest text of each float32 value, to store 0.1 and not 0.10000000149011612
+    args = numpy.empty((len(timestamps), 3), dtype=object)
+    args[:, 0] = series
+    args[:, 1] = timestamps.tolist()
+    args[:, 2] = values.astype(str).tolist()
+    return ["TS.MADD", *args.ravel().tolist()]
+
+
+def iter_madd_commands(devices, chunk_size):
+    """Yields (device_id, TS.MADD command) for all the devices, each command with at most chunk_size samples."""
+    for device_id, (timestamps, values) in devices.items():
+        for start in range(0, len(timestamps), chunk_size):
+            yield device_id, madd_command(f"ts:{device_id}_real", timestamps[start:start + chunk_size],
+                                          values[start:start + chunk_size])
 
-    # Use a generator to read lines without loading the whole file
-    csv_string_generator = (line.decode('utf-8') for line in response['Body'].iter_lines())
-    csv_reader = csv.reader(csv_string_generator, delimiter=';')  # Replace with your delimiter
-    for row in csv_reader:
-        yield row[:n_col]  # Yield only the first num_columns
 
+def send_pipeline(redis_client, batch):
+    """Sends the (device_id, command) batch in a single round trip and returns the number of samples written."""
+    pipe = redis_client.pipeline(transaction=False)
+    for _, command in batch:
+        pipe.execute_command(*command)
+    for (device_id, _), result in zip(batch, pipe.execute()):
+        # TS.MADD returns an error per sample instead of failing the whole command
+        errors = [r for r in result if isinstance(r, redis.exceptions.ResponseError)]
+        if errors:
+            raise redis.exceptions.ResponseError(
+                f"{len(errors)} samples of device {device_id} were not written: {errors[0]}")
+    return sum((len(command) - 1) // 3 for _, command in batch)
 
-def write_dataset_to_redis_timeseries(redis_client, df):
-    """Writes a DataFrame with timestamps as index and device values as columns to RedisTimeSeries."""
+
+def new_samples(redis_client, devices):
+    """Keeps only the samples of each device that are newer than its checkpoint."""
+    if FULL_RELOAD or not devices:
+        return devices
+    checkpoints = redis_client.hmget(CHECKPOINTS_KEY, list(devices))
+    new_devices = {}
+    for (device_id, (timestamps, values)), checkpoint in zip(devices.items(), checkpoints):
+        if checkpoint is not None:
+            newer = timestamps > int(checkpoint)
+            timestamps, values = timestamps[newer], values[newer]
+        new_devices[device_id] = (timestamps, values)
+    return new_devices
+
+
+def create_series(redis_client, devices):
+    """Creates the series of the devices, the ones that already exist get the same duplicate policy."""
+    pipe = redis_client.pipeline(transaction=False)
+    for device_id in devices:
+        # A sample written twice (after a crash) replaces the previous one instead of failing
+        pipe.execute_command("TS.CREATE", f"ts:{device_id}_real", "DUPLICATE_POLICY", "LAST",
+                             "LABELS", "device_id", device_id)
+    existing = []
+    for device_id, result in zip(devices, pipe.execute(raise_on_error=False)):
+        if isinstance(result, Exception):
+            if "already exists" not in str(result):
+                raise result
+            existing.append(device_id)
+    # Series created by an older version of the job have the default policy (BLOCK)
+    if existing:
+        pipe = redis_client.pipeline(transaction=False)
+        for device_id in existing:
+            pipe.execute_command("TS.ALTER", f"ts:{device_id}_real", "DUPLICATE_POLICY", "LAST")
+        pipe.execute()
+
+
+def complete_devices(redis_client, devices, device_ids):
+    """Saves the checkpoint of the devices whose samples are all written, and gives them to the forecasters."""
+    enqueue_once = redis_client.register_script(ENQUEUE_ONCE_SCRIPT)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(CHECKPOINTS_KEY, mapping={device_id: int(devices[device_id][0].max()) for device_id in device_ids})
+    for device_id in device_ids:
+        enqueue_once(keys=[ENQUEUED_KEY, "device_queue"], args=[f"ts:{device_id}"], client=pipe)
+    pipe.execute()
+
+
+def write_dataset_to_redis_timeseries(redis_client, devices, chunk_size=TS_CHUNK_SIZE,
+                                      pipeline_commands=PIPELINE_COMMANDS, connections=WRITER_CONNECTIONS):
+    """Writes the per-device (timestamps, values) arrays to RedisTimeSeries.
+
+    The samples are sent in TS.MADD commands of chunk_size samples, grouped by pipeline_commands
+    in each pipeline (so a pipeline holds the samples of many small devices), and the pipelines are
+    sent by several connections in parallel. Only a few pipelines are built ahead of the ones in flight,
+    so the memory stays constant whatever the size of the dataset.
+    """
     logger.info("Writing dataset to RedisTimeSeries")
+    start = time.perf_counter()
 
-    # Set first row as column name
-    df.set_index(0, inplace=True)
-    df = df.transpose()
-    df.set_index("DATETIME", inplace=True)
+    # The series must exist before any connection adds samples to them
+    create_series(redis_client, devices)
+    devices = new_samples(redis_client, devices)
+    logger.info(f"{sum(1 for timestamps, _ in devices.values() if len(timestamps))} devices have new samples")
 
-    # Iterate over each device
-    pipe = redis_client.pipeline()  # Create a Redis pipeline
-    for index, row in df.iterrows():
-        device_id = index
-        key = f"ts:{device_id}"
+    # Number of commands still to be written for each device, a device is complete when it reaches 0
+    remaining = {device_id: -(-len(timestamps) // chunk_size)
+                 for device_id, (timestamps, _) in devices.items() if len(timestamps)}
 
-        logger.info(f"Writing data for device: {key}")
-        # Prepare data for RedisTimeSeries
-        data = [[int(pd.to_datetime(ts).timestamp() * 1000), value] for ts, value in row[1:].items() if pd.notna(value)]
+    # Checkpoint the devices of the sent pipelines that are now complete, returns the number of samples written
+    def complete(futures):
+        written = 0
+        completed = []
+        for future in futures:
+            written += future.result()
+            for device_id, _ in batches.pop(future):
+                remaining[device_id] -= 1
+                if remaining[device_id] == 0:
+                    completed.append(device_id)
+        # The forecasters only get the devices once all their samples are written
+        if completed:
+            complete_devices(redis_client, devices, completed)
+        return written
 
-        # Use pipeline to add data points for the device
-        pipe.execute_command("TS.CREATE", f"{key}_real", "LABELS", "device_id", device_id)
-        if data:
-            data_insert = [[f"{key}_real"] + sublist for sublist in data]    
-            pipe.execute_command("TS.MADD", *sum(data_insert, []))  # Flatten data into list
-            pipe.execute_command("LPUSH", "device_queue", key)
+    commands = iter_madd_commands(devices, chunk_size)
+    samples = 0
+    batches = {}
+    # The connection pool of redis_client gives its own connection to each thread
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        in_flight = set()
+        while batch := list(islice(commands, pipeline_commands)):
+            if len(in_flight) >= connections * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                samples += complete(done)
+            future = executor.submit(send_pipeline, redis_client, batch)
+            batches[future] = batch
+            in_flight.add(future)
+        samples += complete(in_flight)
 
-        # Execute all the commands in the pipeline
-        pipe.execute() 
-   
-    logger.info("Finished writing dataset to RedisTimeSeries")
+    elapsed = time.perf_counter() - start
+    logger.info(f"Finished writing dataset to RedisTimeSeries: {samples} samples of {len(devices)} devices "
+                f"in {elapsed:.1f}s ({samples / elapsed if elapsed else 0:.0f} samples/s)")
 
 
 if __name__ == "__main__":
@@ -92,19 +346,27 @@ if __name__ == "__main__":
         )
 
         # S3 client from the session
-        s3_client = session.client('s3')
+        # One pooled connection per download worker
+        s3_client = session.client('s3', endpoint_url=S3_ENDPOINT_URL,
+                                   config=Config(max_pool_connections=DOWNLOAD_WORKERS))
 
         bucket_name = 'k8s-class-2024'
         object_name = 'GroupeE_data.csv'
 
-        # Read the CSV file
-        df = pd.DataFrame(read_partial_csv(bucket_name, object_name))
-        # Get only the first 10 columns for demonstration purposes
+        # Nothing to do when the CSV didn't change since the last complete run
+        etag = s3_client.head_object(Bucket=bucket_name, Key=object_name)['ETag']
+        if not FULL_RELOAD and redis_client.get(INGESTED_ETAG_KEY) == etag:
+            logger.info(f"{object_name} ({etag}) is already ingested, nothing to do.")
+        else:
+            # Read the CSV file
+            # Get only the first 10 columns for demonstration purposes
+            devices = read_partial_csv(bucket_name, object_name)
 
-        logger.info("Data read from CSV successfully.")
-        logger.info(f"Number of columns = {len(df.columns)}")
+            logger.info("Data read from CSV successfully.")
+            logger.info(f"Number of devices = {len(devices)}")
 
-        write_dataset_to_redis_timeseries(redis_client, df)
+            write_dataset_to_redis_timeseries(redis_client, devices)
+            redis_client.set(INGESTED_ETAG_KEY, etag)
     except:
         logger.error("Failed to connect to Redis.")
         exit(1)
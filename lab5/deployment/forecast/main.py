@@ -3,6 +3,8 @@ import pandas as pd
 import numpy as np
 import time
 from datetime import datetime
+from numpy.lib.stride_tricks import sliding_window_view
+import tensorflow as tf
 from tensorflow.keras.models import Sequential, load_model
 from tensorflow.keras.layers import LSTM, Dense
 from tensorflow.keras.optimizers import Adam
@@ -43,14 +45,32 @@ def get_data_from_redis(redis_client, key):
     return pd.DataFrame(data, columns=["timestamp", "value"]).set_index("timestamp")
 
 def prepare_data(df, n_steps):
-    """Prepares time-series data for LSTM input."""
+    """Prepares time-series data for LSTM input.
+
+    X[i] is the window of the n_steps values before y[i]. X is a read-only strided view over a single
+    contiguous float32 copy of the series, the overlapping windows are never copied.
+    """
     logger.info(f"Preparing data with {n_steps} steps")
 
-    X, y = [], []
-    for i in range(len(df) - n_steps):
-        X.append(df["value"].iloc[i : i + n_steps].values)
-        y.append(df["value"].iloc[i + n_steps])
-    return np.array(X).reshape(-1, n_steps, 1), np.array(y)
+    values = np.ascontiguousarray(df["value"].to_numpy(dtype=np.float32))
+    if len(values) <= n_steps:
+        return np.empty((0, n_steps, 1), dtype=np.float32), np.empty(0, dtype=np.float32)
+    X = sliding_window_view(values[:-1], n_steps)[:, :, np.newaxis]
+    return X, values[n_steps:]
+
+
+def make_dataset(X, y, batch_size=32, shuffle=True):
+    """tf.data pipeline of (X, y) batches, only one batch of windows is copied out of the view at a time."""
+    def batches():
+        order = np.random.permutation(len(X)) if shuffle else np.arange(len(X))
+        for start in range(0, len(X), batch_size):
+            indexes = order[start:start + batch_size]
+            yield X[indexes], y[indexes]
+
+    return tf.data.Dataset.from_generator(batches, output_signature=(
+        tf.TensorSpec(shape=(None, *X.shape[1:]), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.float32),
+    )).prefetch(tf.data.AUTOTUNE)
 
 def train_or_load_model(X_train, y_train, n_steps):
     """Trains the LSTM model or loads an existing one if available."""
@@ -65,7 +85,11 @@ def train_or_load_model(X_train, y_train, n_steps):
         model.add(LSTM(50, activation='relu', input_shape=(n_steps, 1)))
         model.add(Dense(1))
         model.compile(optimizer=Adam(learning_rate=0.001), loss='mse')
-        model.fit(X_train, y_train, epochs=1, batch_size=32, validation_split=0.2, callbacks=[EarlyStopping(patience=10)])
+        # Like validation_split=0.2: the last 20% of the windows are kept for the validation
+        split = int(len(X_train) * 0.8)
+        validation = make_dataset(X_train[split:], y_train[split:], shuffle=False) if split < len(X_train) else None
+        model.fit(make_dataset(X_train[:split], y_train[:split]), validation_data=validation,
+                  epochs=1, callbacks=[EarlyStopping(patience=10)])
         model.save(MODEL_FILE)  # Save the trained model
         logger.info("Trained and saved new model")
     return model